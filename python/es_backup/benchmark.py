@@ -0,0 +1,455 @@
+#!/usr/bin/env python
+#
+# Author: Devin Cherry <devincherry@gmail.com>
+#############################################################
+""" Benchmarks esbackup operations against a local, mocked ElasticSearch cluster.
+
+Each scenario runs in a fresh process against a mock ES HTTP server (run in its own
+process, serving canned responses for a synthetic cluster with a configurable per-request
+latency), and reports wall time, the number of HTTP requests made and peak memory use. The
+mock formats responses as ES 2.3 does, except for the *_7x scenarios, which run against an
+ES 7.x style mock.
+
+    $ python benchmark.py --sizes 10,100,1000 --latency 0.005
+
+The startup scenarios instead time whole esbackup.py invocations, which cron runs many
+times an hour, and fail if any is slower than --startup-budget.
+
+    $ python benchmark.py startup_help startup_show_config
+"""
+import os
+import sys
+import json
+import fnmatch
+import time
+import argparse
+import resource
+import socket
+import subprocess
+import threading
+import urlparse
+import BaseHTTPServer
+import SocketServer
+from multiprocessing import Process, Pipe
+
+from elasticsearch import Elasticsearch
+
+import esbackup
+
+
+SCENARIOS = [
+    'show_snapshots',
+    'snapshot_running',
+    'show_aliases',
+    'create_alias',
+    'show_indices',
+    'analyze_snapshots',
+    'show_indices_7x',
+    'analyze_snapshots_7x',
+]
+
+# the ES version the mock cluster reports, and the scenarios run against another version
+# (as the scenario they're a variant of, and that version)
+MOCK_VERSION = '2.3.0'
+VERSIONED_SCENARIOS = {
+    'show_indices_7x': ('show_indices', '7.10.2'),
+    'analyze_snapshots_7x': ('analyze_snapshots', '7.10.2'),
+}
+
+# esbackup.py command lines timed by the startup scenarios
+STARTUP_SCENARIOS = {
+    'startup_help': ['--help'],
+    'startup_show_config': ['-f', 'config.yaml.DIST', 'show_config'],
+    'startup_show_config_json': ['-f', 'config.yaml.DIST', '-o', 'json', 'show_config'],
+}
+
+# max seconds a startup scenario may take (the median of its runs)
+STARTUP_BUDGET = 0.25
+
+# number of times each startup scenario is run
+STARTUP_RUNS = 7
+
+# snapshots start at this epoch (seconds), one hour apart
+SNAPSHOT_EPOCH = 1475280000
+
+
+class MockCluster(object):
+    '''Canned responses for a synthetic cluster with `size` repos, indices and aliases.
+
+    Responses are formatted as the given ES version would: _cat output right-aligns numeric
+    columns (and, from 5.0, can be JSON), and 7.x snapshot _status nests its byte counts.'''
+
+    def __init__(self, size, snapshots_per_repo=5, running_repo=None, version=MOCK_VERSION):
+        self.version = version
+        self.major = int(version.split('.')[0])
+        self.repos = ['repo_%05i' % i for i in range(size)] + esbackup.BAD_REPO_NAMES
+        self.indices = ['index_%05i' % i for i in range(size)]
+        self.aliases = dict(('alias_%05i' % i, [index]) for (i, index) in enumerate(self.indices))
+        self.snapshot_names = ['snap_%03i' % i for i in range(snapshots_per_repo)]
+        self.running_repo = running_repo
+
+        self.cat_aliases = [{'alias': a, 'index': i} for a in sorted(self.aliases)
+                            for i in self.aliases[a]]
+        # sizes grow past 10GB, so byte counts get wider than the store.size header
+        self.cat_indices = [{'index': i, 'health': 'green', 'status': 'open', 'pri': 5, 'rep': 1,
+                             'docs.count': n * 1000, 'store.size': n * 3 << 30,
+                             'creation.date': SNAPSHOT_EPOCH * 1000}
+                            for (n, i) in enumerate(self.indices)]
+        self.cat_repositories = [{'id': r, 'type': 's3'} for r in self.repos]
+        index_aliases = dict((i, []) for i in self.indices)
+        for (alias, indices) in self.aliases.items():
+            for index in indices:
+                index_aliases[index].append(alias)
+        self.index_aliases = index_aliases
+        self.get_alias = json.dumps(dict(
+            (i, {'aliases': dict((a, {}) for a in index_aliases[i])}) for i in self.indices))
+        self.get_indices = json.dumps(dict(
+            (i, {'aliases': dict((a, {}) for a in index_aliases[i]),
+                 'mappings': {'doc': {'properties': dict(('field_%i' % f, {'type': 'string'})
+                                                         for f in range(20))}},
+                 'settings': {'index': {'number_of_shards': '5', 'number_of_replicas': '1',
+                                        'creation_date': str(SNAPSHOT_EPOCH * 1000)}}})
+            for i in self.indices))
+
+    def cat(self, rows, query, pattern='*'):
+        '''Returns (content_type, body) of a _cat response for rows (dicts), honouring the h,
+        v, s, format and name parameters, and an index pattern.
+
+        Like ES, text output right-aligns numeric columns (header included), and JSON output
+        has every value as a string.'''
+        columns = query.get('h', [','.join(sorted(rows[0].keys()))] if rows else [''])[0].split(',')
+        name = query.get('name', ['*'])[0]
+        patterns = pattern.split(',')
+        rows = [row for row in rows
+                if fnmatch.fnmatchcase(row.get('alias', ''), name) and
+                any(fnmatch.fnmatchcase(row.get('index', ''), p) for p in patterns)]
+        if 's' in query:
+            (sort_column, _, order) = query['s'][0].partition(':')
+            rows.sort(key=lambda row: row.get(sort_column), reverse=order == 'desc')
+        if query.get('format', ['text'])[0] == 'json' and self.major >= 5:
+            return ('application/json', json.dumps(
+                [dict((c, str(row[c]) if c in row else None) for c in columns) for row in rows]))
+
+        numeric = [bool(rows) and all(isinstance(row.get(c), (int, long)) for row in rows)
+                   for c in columns]
+        table = [[str(row.get(c, '')) for c in columns] for row in rows]
+        if query.get('v', ['false'])[0] == 'true':
+            table.insert(0, columns)
+        widths = [max([len(r[c]) for r in table] or [0]) for c in range(len(columns))]
+        return ('text/plain', ''.join(
+            ' '.join(r[c].rjust(widths[c]) if numeric[c] else r[c].ljust(widths[c])
+                     for c in range(len(columns))) + '\n'
+            for r in table))
+
+    def snapshot(self, name):
+        '''Returns the snapshot info for a snapshot name.'''
+        start = (SNAPSHOT_EPOCH + self.snapshot_names.index(name) * 3600) * 1000
+        return {'snapshot': name, 'version_id': 2030099, 'version': '2.3.0',
+                'indices': self.indices[:3], 'state': 'SUCCESS',
+                'start_time_in_millis': start, 'end_time_in_millis': start + 60000,
+                'duration_in_millis': 60000, 'failures': [],
+                'shards': {'total': 15, 'failed': 0, 'successful': 15}}
+
+    def status_stats(self, incremental, processed, start, millis):
+        '''Returns the 'stats' of a _status response, as formatted by the cluster's version.
+
+        7.x nests the counts, adds the files reused from earlier snapshots to 'total', and
+        leaves out 'processed' once it's equal to 'incremental'.'''
+        if self.major < 7:
+            return {'number_of_files': 100, 'processed_files': 100 * processed / incremental,
+                    'total_size_in_bytes': incremental, 'processed_size_in_bytes': processed,
+                    'start_time_in_millis': start, 'time_in_millis': millis}
+        stats = {'incremental': {'file_count': 100, 'size_in_bytes': incremental},
+                 'total': {'file_count': 400, 'size_in_bytes': incremental * 4},
+                 'start_time_in_millis': start, 'time_in_millis': millis}
+        if processed != incremental:
+            stats['processed'] = {'file_count': 100 * processed / incremental,
+                                  'size_in_bytes': processed}
+        return stats
+
+    def snapshot_status(self, repo):
+        '''Returns the _status response for a repo.'''
+        if repo != self.running_repo:
+            return {'snapshots': []}
+        return {'snapshots': [{
+            'snapshot': 'running', 'repository': repo, 'state': 'STARTED',
+            'shards_stats': {'initializing': 0, 'started': 5, 'finalizing': 0, 'done': 10,
+                             'failed': 0, 'total': 15},
+            'stats': self.status_stats(1 << 30, 1 << 29, SNAPSHOT_EPOCH * 1000, 60000),
+            'indices': {}}]}
+
+    def completed_status(self, repo, name):
+        '''Returns the _status of a completed snapshot; later snapshots are bigger.'''
+        n = self.snapshot_names.index(name) + 1
+        start = self.snapshot(name)['start_time_in_millis']
+        indices = dict((i, {'shards_stats': {'done': 5, 'total': 5},
+                            'stats': self.status_stats(n * (k + 1) << 20, n * (k + 1) << 20,
+                                                       start, 1000 * (k + 1))})
+                       for (k, i) in enumerate(self.indices[:3]))
+        return {'snapshot': name, 'repository': repo, 'state': 'SUCCESS',
+                'shards_stats': {'done': 15, 'total': 15},
+                'stats': self.status_stats(n * 6 << 20, n * 6 << 20, start, 60000),
+                'indices': indices}
+
+    def respond(self, method, path, query):
+        '''Returns (status, content_type, body) for a request.'''
+        parts = [urlparse.unquote(p) for p in path.strip('/').split('/') if p != '']
+        if not parts:
+            return (200, 'application/json', json.dumps(
+                {'name': 'mock', 'cluster_name': 'mock', 'version': {'number': self.version}}))
+
+        if parts[0] == '_cat':
+            if parts[1:] == ['repositories']:
+                return (200,) + self.cat(self.cat_repositories, query)
+            if parts[1] == 'snapshots':
+                return (200,) + self.cat([{'id': n, 'status': 'SUCCESS',
+                                           'start_epoch': SNAPSHOT_EPOCH + i * 3600}
+                                          for (i, n) in enumerate(self.snapshot_names)], query)
+            if parts[1] == 'aliases':
+                if len(parts) > 2:
+                    query['name'] = [parts[2]]
+                return (200,) + self.cat(self.cat_aliases, query)
+            if parts[1] == 'indices':
+                pattern = parts[2] if len(parts) > 2 else '*'
+                return (200,) + self.cat(self.cat_indices, query, pattern)
+            if parts[1] == 'shards':
+                pattern = parts[2] if len(parts) > 2 else '*'
+                return (200,) + self.cat([{'index': i, 'shard': n, 'prirep': 'p', 'state': 'STARTED'}
+                                          for i in self.indices for n in range(5)], query, pattern)
+
+        if parts[0] == '_snapshot' and len(parts) == 3:
+            if method == 'PUT':
+                if parts[2] not in self.snapshot_names:
+                    self.snapshot_names.append(parts[2])
+                return (200, 'application/json', json.dumps({'accepted': True}))
+            if parts[2] == '_status':
+                return (200, 'application/json', json.dumps(self.snapshot_status(parts[1])))
+            if parts[2] == '*':
+                names = self.snapshot_names
+            else:
+                # like ES, a missing name fails the whole request unless ignore_unavailable is set
+                names = [n for n in parts[2].split(',') if n in self.snapshot_names]
+                if len(names) < len(parts[2].split(',')) and query.get('ignore_unavailable') != ['true']:
+                    return (404, 'application/json', json.dumps({'status': 404}))
+            return (200, 'application/json',
+                    json.dumps({'snapshots': [self.snapshot(n) for n in names]}))
+
+        if parts == ['_aliases'] or (len(parts) == 3 and parts[1] == '_alias' and method == 'PUT'):
+            return (200, 'application/json', json.dumps({'acknowledged': True}))
+
+        if len(parts) in (2, 3) and parts[1] == '_alias':
+            if parts[0] == '*':
+                return (200, 'application/json', self.get_alias)
+            patterns = parts[0].split(',')
+            return (200, 'application/json', json.dumps(dict(
+                (i, {'aliases': dict((a, {}) for a in self.index_aliases[i])})
+                for i in self.indices if any(fnmatch.fnmatchcase(i, p) for p in patterns))))
+
+        if parts[0] == '_snapshot' and len(parts) == 4 and parts[3] == '_status':
+            return (200, 'application/json', json.dumps({'snapshots': [
+                self.completed_status(parts[1], n) for n in parts[2].split(',')]}))
+
+        if parts[0] == '_snapshot' and len(parts) == 4 and parts[3] == '_restore':
+            return (200, 'application/json', json.dumps({'accepted': True}))
+
+        if len(parts) == 2 and parts[1] == '_recovery':
+            shard = {'id': 0, 'type': 'SNAPSHOT', 'stage': 'DONE',
+                     'index': {'size': {'total_in_bytes': 1048576, 'recovered_in_bytes': 1048576},
+                               'files': {'total': 10, 'recovered': 10}}}
+            return (200, 'application/json', json.dumps(dict(
+                (i, {'shards': [shard]}) for i in parts[0].split(','))))
+
+        if parts[0] == '_cluster' and parts[1] == 'health':
+            return (200, 'application/json', json.dumps({'status': 'green'}))
+
+        if len(parts) >= 2 and parts[1] == '_settings' and method == 'PUT':
+            return (200, 'application/json', json.dumps({'acknowledged': True}))
+
+        if len(parts) >= 2 and parts[1] == '_settings':
+            patterns = parts[0].split(',')
+            return (200, 'application/json', json.dumps(dict(
+                (i, {'settings': {'index': {'creation_date': str(SNAPSHOT_EPOCH * 1000)}}})
+                for i in self.indices if any(fnmatch.fnmatchcase(i, p) for p in patterns))))
+
+        if method == 'DELETE' and len(parts) == 1:
+            return (200, 'application/json', json.dumps({'acknowledged': True}))
+
+        if parts == ['*']:
+            return (200, 'application/json', self.get_indices)
+
+        return (404, 'application/json', json.dumps({'error': 'unhandled: %s %s' % (method, path),
+                                                     'status': 404}))
+
+
+class MockHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''Serves MockCluster responses, counting requests and sleeping `latency` on each.'''
+    protocol_version = 'HTTP/1.1'
+    # buffer each response and send it without Nagle delays, so the mock's latency is
+    # only what was asked for
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def handle_one(self):
+        length = int(self.headers.getheader('content-length') or 0)
+        if length:
+            self.rfile.read(length)
+        url = urlparse.urlparse(self.path)
+
+        if url.path == '/_bench/stats':
+            (status, ctype, body) = (200, 'application/json',
+                                     json.dumps({'requests': self.server.requests}))
+        elif url.path == '/_bench/reset':
+            self.server.requests = 0
+            (status, ctype, body) = (200, 'application/json', '{}')
+        else:
+            with self.server.lock:
+                self.server.requests += 1
+            time.sleep(self.server.latency)
+            (status, ctype, body) = self.server.cluster.respond(self.command, url.path,
+                                                                urlparse.parse_qs(url.query))
+
+        self.send_response(status)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    do_GET = do_PUT = do_POST = do_DELETE = do_HEAD = handle_one
+
+    def log_message(self, *args):
+        pass
+
+
+class MockServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def handle_error(self, request, client_address):
+        # clients exiting with keep-alive connections still open is expected
+        if not isinstance(sys.exc_info()[1], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+
+def serve(cluster, latency, conn):
+    '''Runs a mock server in the current process, sending its port back over conn.'''
+    server = MockServer(('127.0.0.1', 0), MockHandler)
+    server.cluster = cluster
+    server.latency = latency
+    server.requests = 0
+    server.lock = threading.Lock()
+    conn.send(server.server_address[1])
+    server.serve_forever()
+
+
+def run_scenario(scenario, port, conn):
+    '''Runs one scenario against the mock server, sending (wall_time, peak_rss_kb) back.'''
+    esbackup.OPTS = argparse.Namespace(verbose=False)
+    es = Elasticsearch(['http://127.0.0.1:%i/' % port],
+                       connection_class=esbackup.pooled_connection_class())
+    es.transport.perform_request('GET', '/_bench/reset')
+
+    devnull = open(os.devnull, 'w')
+    (stdout, sys.stdout) = (sys.stdout, devnull)
+    start = time.time()
+    try:
+        if scenario == 'show_snapshots':
+            esbackup.show_snapshots(es)
+        elif scenario == 'snapshot_running':
+            getattr(esbackup, '__snapshot_running')(es)
+        elif scenario == 'show_aliases':
+            esbackup.show_aliases(es)
+        elif scenario == 'create_alias':
+            esbackup.create_alias(es, 'bench_alias', 'index_00000,index_00001,index_00002')
+        elif scenario == 'show_indices':
+            esbackup.show_indices(es, columns=['index', 'health', 'docs.count', 'store.size'],
+                                  min_bytes=1, sort='-store.size')
+        elif scenario == 'analyze_snapshots':
+            esbackup.show_snapshot_analysis(esbackup.analyze_snapshots(es))
+    finally:
+        elapsed = time.time() - start
+        sys.stdout = stdout
+    conn.send((elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+
+def benchmark(scenario, size, latency, snapshots_per_repo):
+    '''Benchmarks a scenario on a synthetic cluster of the given size.
+
+    Returns (wall_time, request_count, peak_rss_kb).'''
+    (scenario, version) = VERSIONED_SCENARIOS.get(scenario, (scenario, MOCK_VERSION))
+    cluster = MockCluster(size, snapshots_per_repo, running_repo='repo_%05i' % (size - 1),
+                          version=version)
+    (parent_conn, child_conn) = Pipe()
+    server = Process(target=serve, args=(cluster, latency, child_conn))
+    server.daemon = True
+    server.start()
+    port = parent_conn.recv()
+    try:
+        client = Process(target=run_scenario, args=(scenario, port, child_conn))
+        client.start()
+        (elapsed, peak_rss) = parent_conn.recv()
+        client.join()
+
+        stats = Elasticsearch(['http://127.0.0.1:%i/' % port]).transport.perform_request(
+            'GET', '/_bench/stats')
+        if isinstance(stats, tuple):
+            stats = stats[1]
+    finally:
+        server.terminate()
+    return (elapsed, stats['requests'], peak_rss)
+
+
+def startup_time(args, runs=STARTUP_RUNS):
+    '''Runs esbackup.py with the given arguments in a fresh interpreter, `runs` times.
+
+    Returns the median wall time; the first run also warms esbackup's config cache.'''
+    here = os.path.dirname(os.path.abspath(__file__))
+    times = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(runs):
+            start = time.time()
+            subprocess.check_call([sys.executable, os.path.join(here, 'esbackup.py')] + args,
+                                  cwd=here, stdout=devnull)
+            times.append(time.time() - start)
+    return sorted(times)[len(times) / 2]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks esbackup operations against a mocked ElasticSearch cluster.")
+    parser.add_argument('-s', '--sizes', dest='sizes', default='10,100,1000',
+                        help="Comma-separated synthetic cluster sizes (number of repos, indices and aliases). (default: 10,100,1000)")
+    parser.add_argument('-l', '--latency', dest='latency', type=float, default=0.005,
+                        help="Seconds of latency added to each mock ES request. (default: 0.005)")
+    parser.add_argument('--snapshots-per-repo', dest='snapshots_per_repo', type=int, default=5,
+                        help="Number of snapshots in each synthetic repo. (default: 5)")
+    parser.add_argument('--startup-budget', dest='startup_budget', type=float, default=STARTUP_BUDGET,
+                        help="Max seconds a startup scenario may take. (default: %.2f)" % STARTUP_BUDGET)
+    parser.add_argument('scenarios', nargs='*', default=SCENARIOS,
+                        help="Scenarios to run. (default: %s; also: %s)" % (', '.join(SCENARIOS),
+                                                                           ', '.join(sorted(STARTUP_SCENARIOS))))
+    OPTS = parser.parse_args()
+
+    OVER_BUDGET = []
+    print "%-24s %8s %10s %9s %12s" % ('SCENARIO', 'SIZE', 'WALL(s)', 'REQUESTS', 'PEAK_RSS(MB)')
+    for SCENARIO in OPTS.scenarios:
+        if SCENARIO in STARTUP_SCENARIOS:
+            ELAPSED = startup_time(STARTUP_SCENARIOS[SCENARIO])
+            print "%-24s %8s %10.3f %9s %12s" % (SCENARIO, '-', ELAPSED, '-', '-')
+            if ELAPSED > OPTS.startup_budget:
+                OVER_BUDGET.append(SCENARIO)
+            continue
+        if SCENARIO not in SCENARIOS:
+            print >>sys.stderr, "ERROR: Unknown scenario [%s]!" % SCENARIO
+            sys.exit(1)
+        for SIZE in [int(s) for s in OPTS.sizes.split(',')]:
+            (ELAPSED, REQUESTS, PEAK_RSS) = benchmark(SCENARIO, SIZE, OPTS.latency,
+                                                      OPTS.snapshots_per_repo)
+            print "%-24s %8i %10.3f %9i %12.1f" % (SCENARIO, SIZE, ELAPSED, REQUESTS, PEAK_RSS / 1024.0)
+            sys.stdout.flush()
+
+    if OVER_BUDGET:
+        print >>sys.stderr, "ERROR: Over the %.2fs startup budget: %s" % (OPTS.startup_budget, ', '.join(OVER_BUDGET))
+        sys.exit(1)
+
+
+# vim: ts=4 sw=4 et
@@ -2,14 +2,53 @@
 #
 # Author: Devin Cherry <devincherry@gmail.com>
 #############################################################
-""" A tool for managing AWS ElasticSearch snapshots. """
+""" A tool for managing AWS ElasticSearch snapshots.
+
+Every subcommand is backed by a function which can be imported and called in-process. These
+return plain dicts/lists (generators, for listings), report per-item failures in their
+results, and raise EsBackupError on failure, or elasticsearch's TransportError when a request
+to the cluster fails. run_command() turns the latter into EsBackupError too.
+"""
+import os
+import re
+import atexit
 import sys
+import json
 import argparse
 import time
-from datetime import datetime
-import yaml
-from elasticsearch import Elasticsearch, RequestsHttpConnection, exceptions
-from requests_aws4auth import AWS4Auth
+import random
+import calendar
+import fnmatch
+import threading
+import types
+import hashlib
+import Queue
+from multiprocessing.pool import ThreadPool
+from StringIO import StringIO
+from datetime import datetime, timedelta
+
+
+class LazyModule(object):
+    '''Stands in for a module which is slow to import, importing it on first use.'''
+
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+    def __getattr__(self, attr):
+        if self.module is None:
+            __import__(self.name)
+            self.module = sys.modules[self.name]
+        return getattr(self.module, attr)
+
+
+# the yaml parser and elasticsearch client stack take a few hundred ms to import, so
+# they're only imported once a subcommand actually needs them
+yaml = LazyModule('yaml')
+requests = LazyModule('requests')
+elasticsearch = LazyModule('elasticsearch')
+exceptions = LazyModule('elasticsearch.exceptions')
+requests_aws4auth = LazyModule('requests_aws4auth')
 
 
 OPTS = None
@@ -20,106 +59,913 @@ BAD_REPO_NAMES = [
     'cs-automated'
 ]
 
+# max number of concurrent snapshot status requests when polling a cluster
+POLL_WORKERS = 8
+
+# max number of clusters to operate on concurrently in --clusters/--all-clusters mode
+FANOUT_WORKERS = 16
+
+# number of keep-alive HTTP connections each cached cluster client may hold open
+POOL_MAXSIZE = 16
+
+# skip the connection ping() if the cluster answered one within this many seconds
+HEALTH_CHECK_TTL = 60
+
+# elasticsearch clients cached per cluster; see elasticsearch_connection()
+_CLIENTS = {}
+_CLIENTS_LOCK = threading.Lock()
+
+# cluster version numbers, keyed by client; see cluster_version()
+_VERSIONS = {}
+
+# where cached cluster metadata is kept, and for how long it's trusted (both can be
+# overridden with the 'cache_dir' and 'catalog_ttl' config keys)
+DEFAULT_CACHE_DIR = '~/.esbackup'
+CATALOG_TTL = 300
+
+# max number of snapshot names to request at once when refreshing the catalog
+CATALOG_FETCH_BATCH = 50
+
+# number of snapshots fetched per request when streaming show_snapshots output
+SNAPSHOT_PAGE_SIZE = 100
+
+# max number of completed snapshots whose _status is requested at once by analyze_snapshots
+# (each is read back from the repository, so these requests are slow)
+STATUS_FETCH_BATCH = 10
+
+# number of slowest indices listed by analyze_snapshots
+ANALYZE_TOP_INDICES = 10
+
+# max number of snapshot names passed to one multi-snapshot delete (ES >= 7.8 only)
+DELETE_BATCH_SIZE = 20
+
+# times to retry a delete rejected because another snapshot operation is in progress
+DELETE_RETRIES = 8
+
+# _cat/indices columns which hold byte and document counts, for filtering and sorting
+INDEX_SIZE_COLUMNS = ['store.size', 'pri.store.size']
+INDEX_NUMERIC_COLUMNS = INDEX_SIZE_COLUMNS + ['docs.count', 'docs.deleted', 'pri', 'rep']
+
+# max length of the comma-joined index names sent in one delete request (keeps URLs sane)
+DELETE_INDEX_BATCH_CHARS = 3000
+
+# seconds between recovery progress reports while watching a restore, and the longest to
+# wait for a restore to recover (and go green, if aliases are to be added)
+RESTORE_POLL_INTERVAL = 5
+RESTORE_TIMEOUT = 86400
+
+# seconds between checks of each cluster's schedule/snapshot state in scheduler mode
+SCHEDULER_TICK = 10
+
+# bounds (in seconds) for the adaptive poll interval used by watch_snapshot
+MIN_POLL_INTERVAL = 2
+MAX_POLL_INTERVAL = 120
+
+# the connection class used for cluster clients; built by pooled_connection_class()
+PooledRequestsHttpConnection = None
+
+# callables run after every request to a cluster, as
+# hook(host, method, url, seconds, response_bytes, status, retry); see RequestStats
+REQUEST_HOOKS = []
+
+# HTTP statuses (besides connection errors) after which a request may be retried
+RETRYABLE_STATUSES = (429, 502, 503, 504)
+
+# HTTP methods which are resent after a connection error, timeout or 5xx, where the cluster
+# may already have acted on the request. ES PUTs and DELETEs aren't idempotent (re-creating
+# a snapshot or re-deleting an index fails), so they, like POSTs, are only retried after a
+# 429, which means the request was rejected unprocessed
+IDEMPOTENT_METHODS = ('GET', 'HEAD')
+
+# default number of times a failed request is retried (overridden by a cluster's
+# 'max_retries' config key), and the bounds (in seconds) of the jittered, exponential
+# backoff between attempts
+REQUEST_RETRIES = 5
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30
+
+# the transport class used for cluster clients; built by retrying_transport_class()
+RetryingTransport = None
+
+# upper bounds (in seconds) of the request latency histogram buckets
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+# the last retryable request which failed on each thread; see pooled_connection_class()
+_REQUEST_LOCAL = threading.local()
+
+
+class EsBackupError(Exception):
+    '''Raised when an esbackup operation can't be completed.'''
+    pass
+
 
 def __error_exit(msg):
     print >>sys.stderr, "ERROR: %s" % msg
     sys.exit(1)
 
 
-def __snapshot_running(es):
-    '''Returns True if a snapshot is running in any discovered repo.'''
+def __verbose():
+    '''True if verbose output was requested on the command line.'''
+    return OPTS is not None and OPTS.verbose
+
+
+def __say(msg):
+    '''Prints a progress/status message, unless esbackup is being used as a library or
+    the command line asked for json/ndjson output.'''
+    if OPTS is not None and getattr(OPTS, 'output', 'text') == 'text':
+        print msg
+        sys.stdout.flush()
+
+
+def __say_error(msg):
+    '''Like __say(), but prints an error message to stderr.'''
+    if OPTS is not None and getattr(OPTS, 'output', 'text') == 'text':
+        print >>sys.stderr, "ERROR: %s" % msg
+
+
+def __materialize(result):
+    '''Turns a generator result (i.e. a listing) into a list, so it can be kept around.'''
+    if isinstance(result, types.GeneratorType):
+        return list(result)
+    return result
+
+
+def __failed(result):
+    '''True if a command result reports items which failed (i.e. undeleted snapshots).'''
+    return isinstance(result, dict) and bool(result.get('failed') or result.get('error'))
+
+
+def emit(result, output_format='json', cluster_name=None):
+    '''Prints a command result as a single json document, or as ndjson: one line per row of
+    a listing, or a single line for any other result. With a cluster_name, ndjson rows are
+    tagged with a 'cluster' key.'''
+    if output_format == 'json':
+        print json.dumps(__materialize(result), indent=2, sort_keys=True)
+        return
+
+    if not isinstance(result, (list, types.GeneratorType)):
+        result = [result]
+    for row in result:
+        if cluster_name is not None:
+            row = dict(row, cluster=cluster_name) if isinstance(row, dict) else {'cluster': cluster_name, 'value': row}
+        print json.dumps(row, sort_keys=True)
+        sys.stdout.flush()
+
+
+def __list_repos(es):
+    '''Returns the names of all snapshot repositories on the cluster, minus BAD_REPO_NAMES.'''
     repos_raw = es.cat.repositories(v=False)
     repos = []
     for line in repos_raw.split('\n'):
         if line == '':
             continue
-        repos.append(line.split()[0].strip())
+        repo = line.split()[0].strip()
+        # skip any AWS-maintained snapshot repos, since we won't have access...
+        if repo not in BAD_REPO_NAMES:
+            repos.append(repo)
+    return repos
+
+
+def poll_snapshot_status(es, repos, workers=POLL_WORKERS):
+    '''Queries the snapshot status of all given repos concurrently.
+
+    Returns a tuple of (running_snapshots, elapsed_seconds). Returns as soon as any repo
+    reports a running snapshot; requests still in flight are left to finish in the background.
+    '''
+    start = time.time()
+    tasks = Queue.Queue()
+    results = Queue.Queue()
+    stop = threading.Event()
+    for r in repos:
+        tasks.put(r)
 
-    for bad_repo in BAD_REPO_NAMES:
-        repos.remove(bad_repo)
+    def worker():
+        while not stop.is_set():
+            try:
+                repo = tasks.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results.put((es.snapshot.status(repository=repo), None))
+            except Exception as e:
+                results.put((None, e))
+
+    for _ in range(min(workers, len(repos))):
+        t = threading.Thread(target=worker)
+        t.daemon = True
+        t.start()
+
+    running = []
+    try:
+        remaining = len(repos)
+        while remaining > 0:
+            # a blocking get() without a timeout can't be interrupted by ^C in python2
+            try:
+                (status, err) = results.get(True, 1)
+            except Queue.Empty:
+                continue
+            remaining -= 1
+            if err is not None:
+                raise err
+            if status['snapshots']:
+                running = status['snapshots']
+                break
+    finally:
+        stop.set()
+
+    return (running, time.time() - start)
+
+
+def __snapshot_running(es, workers=POLL_WORKERS):
+    '''Returns True if a snapshot is running in any discovered repo.'''
+    (running, _) = poll_snapshot_status(es, __list_repos(es), workers)
+    return bool(running)
+
+
+def cache_path(cfg, cluster_name, kind):
+    '''Returns the path of the on-disk cache file of the given kind for a cluster.'''
+    cache_dir = os.path.expanduser(cfg.get('cache_dir', DEFAULT_CACHE_DIR))
+    return os.path.join(cache_dir, "%s.%s.json" % (cluster_name, kind))
+
+
+def __load_cache(path):
+    '''Returns the data stored in a cache file, or None if it's missing or unreadable.'''
+    try:
+        with open(path, 'r') as fp:
+            return json.load(fp)
+    except (IOError, ValueError):
+        return None
+
+
+def __save_cache(path, data):
+    '''Atomically replaces the contents of a cache file (readable only by its owner).'''
+    cache_dir = os.path.dirname(path)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir, 0700)
+    payload = json.dumps(data)
+    tmp_path = "%s.%i.tmp" % (path, os.getpid())
+    with os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600), 'w') as fp:
+        fp.write(payload)
+    os.rename(tmp_path, path)
+
+
+def load_config(path, use_cache=True):
+    '''Returns the parsed yaml config file.
+
+    The parsed config (credentials included) is cached as json in the config's cache_dir,
+    readable only by its owner, and keyed on the file's path, mtime and size, so runs with
+    an unchanged config skip importing and running the yaml parser. cache_dir is found with
+    a plain text match, and nothing is cached if the parsed config disagrees with it.
+    '''
+    path = os.path.abspath(path)
+    with open(path, 'r') as fp:
+        text = fp.read()
+        stat = os.fstat(fp.fileno())
+    key = [path, stat.st_mtime, stat.st_size]
+    match = re.search(r'''^cache_dir:[ \t]*['"]?([^'"#\r\n]*?)['"]?[ \t]*(#.*)?$''', text, re.M)
+    cache_dir = match.group(1) if match else DEFAULT_CACHE_DIR
+    cache_file = os.path.join(os.path.expanduser(cache_dir),
+                              "config.%s.json" % hashlib.md5(path).hexdigest())
+    if use_cache:
+        cached = __load_cache(cache_file)
+        if cached and cached.get('key') == key:
+            return cached['config']
+
+    cfg = yaml.safe_load(text)
+    if use_cache and isinstance(cfg, dict) and cfg.get('cache_dir', DEFAULT_CACHE_DIR) == cache_dir:
+        try:
+            __save_cache(cache_file, {'key': key, 'config': cfg})
+        except (IOError, OSError, TypeError, ValueError):
+            # i.e. an unwritable cache dir, or values (like dates) json can't hold
+            pass
+    return cfg
+
+
+def __list_snapshot_names(es, repo):
+    '''Returns the names of all snapshots in a repo, oldest first, via the lightweight
+    _cat/snapshots API.'''
+    names_raw = es.cat.snapshots(repository=repo, h='id', v=False)
+    return [line.strip() for line in names_raw.split('\n') if line.strip() != '']
+
+
+def snapshot_catalog(es, cache_file=None, ttl=CATALOG_TTL):
+    '''Returns a dict of {repo_name: [snapshot_info, ...]} for all repos on the cluster.
+
+    If cache_file is given, a catalog younger than ttl seconds is returned straight from
+    disk. Older catalogs are refreshed incrementally: only snapshots that are new, or were
+    still running when cached, are fetched from the cluster. Snapshots that have since been
+    deleted are dropped, including those deleted between listing and fetching them.
+    Snapshots are always fetched CATALOG_FETCH_BATCH names at a time, so even filling a
+    catalog of a large repo never needs a single huge response.
+    '''
+    cached = __load_cache(cache_file) if cache_file else None
+    if cached and time.time() - cached['updated'] < ttl:
+        return cached['repos']
+
+    catalog = {}
+    for r in __list_repos(es):
+        known = {}
+        if cached and r in cached['repos']:
+            known = dict((s['snapshot'], s) for s in cached['repos'][r])
+        names = __list_snapshot_names(es, r)
+        fetch = [n for n in names if n not in known or known[n]['state'] == 'IN_PROGRESS']
+        for i in range(0, len(fetch), CATALOG_FETCH_BATCH):
+            batch = fetch[i:i + CATALOG_FETCH_BATCH]
+            for s in es.snapshot.get(repository=r, snapshot=','.join(batch),
+                                     params={'ignore_unavailable': 'true'})['snapshots']:
+                known[s['snapshot']] = s
+        catalog[r] = [known[n] for n in names if n in known]
+        if __verbose():
+            __say("Catalog for repo [%s]: %i snapshots, %i fetched" % (r, len(names), len(fetch)))
+
+    if cache_file:
+        __save_cache(cache_file, {'updated': time.time(), 'repos': catalog})
+    return catalog
+
+
+def __snapshot_matches(name, start_millis, pattern='*', since=None, until=None):
+    '''Returns True if a snapshot name/start time passes the given filters. since and
+    until are epoch milliseconds (inclusive), or None to leave that end unbounded.'''
+    if not fnmatch.fnmatchcase(name, pattern):
+        return False
+    if since is not None and (start_millis is None or start_millis < since):
+        return False
+    if until is not None and (start_millis is None or start_millis > until):
+        return False
+    return True
+
+
+def iter_snapshots(es, repos=None, pattern='*', since=None, until=None,
+                   page_size=SNAPSHOT_PAGE_SIZE, catalog=None):
+    '''Yields (repo_name, snapshot_info) for each matching snapshot, oldest first per repo.
+
+    If a catalog (see snapshot_catalog()) is given, snapshots are read from it. Otherwise
+    each repo is listed via _cat/snapshots, the filters are applied to that lightweight
+    listing, and only the matching snapshots are fetched, page_size names per request, so
+    results are yielded as each page arrives rather than after the whole repo is loaded.
+    '''
+    if repos is None:
+        repos = sorted(catalog.keys()) if catalog is not None else __list_repos(es)
 
     for r in repos:
-        status = es.snapshot.status(repository=r)
-        if status['snapshots']:
-            return True
-    return False
+        if catalog is not None:
+            for s in catalog.get(r, []):
+                if __snapshot_matches(s['snapshot'], s.get('start_time_in_millis'),
+                                      pattern, since, until):
+                    yield (r, s)
+            continue
+
+        names = []
+        for line in es.cat.snapshots(repository=r, h='id,start_epoch', v=False).split('\n'):
+            fields = line.split()
+            if len(fields) < 2:
+                continue
+            if __snapshot_matches(fields[0], int(fields[1]) * 1000, pattern, since, until):
+                names.append(fields[0])
+
+        for i in range(0, len(names), page_size):
+            page = es.snapshot.get(repository=r, snapshot=','.join(names[i:i + page_size]),
+                                   params={'ignore_unavailable': 'true'})
+            for s in page['snapshots']:
+                yield (r, s)
+
+
+def listed_snapshots(es, catalog_file=None, ttl=CATALOG_TTL, repos=None, pattern='*',
+                     since=None, until=None, page_size=SNAPSHOT_PAGE_SIZE):
+    '''Yields (repo_name, snapshot_info) for each matching snapshot, as iter_snapshots() does,
+    keeping the catalog in catalog_file (if given) warm.
+
+    Once there's a catalog, it's read through snapshot_catalog(), which refreshes it
+    incrementally when stale. Without one, snapshots are streamed from the cluster page by
+    page; an unfiltered listing then saves what it streamed as the catalog.
+    '''
+    if catalog_file and __load_cache(catalog_file):
+        catalog = snapshot_catalog(es, catalog_file, ttl)
+        for row in iter_snapshots(es, repos, pattern, since, until, page_size, catalog):
+            yield row
+        return
+
+    complete = bool(catalog_file) and (repos, pattern, since, until) == (None, '*', None, None)
+    catalog = {}
+    for (r, s) in iter_snapshots(es, repos, pattern, since, until, page_size):
+        if complete:
+            catalog.setdefault(r, []).append(s)
+        yield (r, s)
+    if complete:
+        __save_cache(catalog_file, {'updated': time.time(), 'repos': catalog})
 
 
-def elasticsearch_connection(cluster, username, password, ca_cert_path):
-    '''Create and return an elasticsearch connection object.'''
+def parse_date(value):
+    '''Converts a "YYYY-MM-DD" or "YYYY-MM-DDTHH:MM:SS" UTC date string to epoch millis.'''
+    for fmt in ['%Y-%m-%dT%H:%M:%S', '%Y-%m-%d']:
+        try:
+            return calendar.timegm(datetime.strptime(value, fmt).timetuple()) * 1000
+        except ValueError:
+            continue
+    raise EsBackupError("Invalid date [%s]! Expected YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS." % value)
+
+
+def __format_millis(millis):
+    '''Formats epoch milliseconds as a UTC timestamp.'''
+    if not millis:
+        return '-'
+    return datetime.utcfromtimestamp(millis / 1000).strftime('%Y-%m-%dT%H:%M:%S')
+
+
+def __format_bytes(num_bytes):
+    '''Returns a human readable representation of a byte count.'''
+    for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
+        if abs(num_bytes) < 1024.0 or unit == 'TB':
+            break
+        num_bytes /= 1024.0
+    return "%.1f%s" % (num_bytes, unit)
+
+
+def snapshot_progress(snapshot_status):
+    '''Returns (processed_bytes, total_bytes, elapsed_seconds, done_shards, total_shards)
+    for a snapshot status dict, as returned by es.snapshot.status(). total_bytes is what the
+    snapshot has to copy, leaving out files reused from earlier snapshots.'''
+    stats = snapshot_status.get('stats', {})
+    if 'incremental' in stats:
+        # ES >= 7.x nests the byte counts, counts reused files in 'total', and leaves out
+        # 'processed' once it's caught up with 'incremental'
+        total = stats['incremental']['size_in_bytes']
+        processed = stats.get('processed', stats['incremental'])['size_in_bytes']
+    else:
+        processed = stats.get('processed_size_in_bytes', 0)
+        total = stats.get('total_size_in_bytes', 0)
+    elapsed = stats.get('time_in_millis', 0) / 1000.0
+    shards = snapshot_status.get('shards_stats', {})
+    return (processed, total, elapsed, shards.get('done', 0), shards.get('total', 0))
+
+
+def next_poll_interval(remaining_bytes, throughput, min_interval=MIN_POLL_INTERVAL,
+                       max_interval=MAX_POLL_INTERVAL):
+    '''Picks a poll interval from the estimated time remaining.
+
+    Polls roughly four times over the remaining ETA, so checks get more frequent as the
+    snapshot approaches completion and back off on multi-hour snapshots.
+    '''
+    if throughput <= 0:
+        return min_interval
+    eta = remaining_bytes / throughput
+    return max(min_interval, min(max_interval, eta / 4.0))
+
+
+def pooled_connection_class():
+    '''Returns PooledRequestsHttpConnection, a RequestsHttpConnection whose keep-alive pool is
+    sized for concurrent requests. It's defined on first use, as subclassing needs the
+    elasticsearch client imported.'''
+    global PooledRequestsHttpConnection
+    if PooledRequestsHttpConnection is not None:
+        return PooledRequestsHttpConnection
+
+    class PooledConnection(elasticsearch.RequestsHttpConnection):
+        def __init__(self, pool_maxsize=POOL_MAXSIZE, **kwargs):
+            super(PooledConnection, self).__init__(**kwargs)
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+            self.session.mount('https://', adapter)
+            self.session.mount('http://', adapter)
+
+        def perform_request(self, method, url, params=None, body=None, timeout=None, ignore=()):
+            if not REQUEST_HOOKS:
+                return super(PooledConnection, self).perform_request(method, url, params, body,
+                                                                     timeout, ignore)
+
+            # the transport retries a request on the same thread, straight after it failed
+            attempt = (self.host, method, url)
+            retry = getattr(_REQUEST_LOCAL, 'failed', None) == attempt
+            _REQUEST_LOCAL.failed = None
+            (status, size) = (None, 0)
+            start = time.time()
+            try:
+                (status, headers, data) = super(PooledConnection, self).perform_request(
+                    method, url, params, body, timeout, ignore)
+                size = len(data or '')
+                return (status, headers, data)
+            except exceptions.TransportError as e:
+                status = e.status_code
+                if isinstance(e, exceptions.ConnectionError) or status in RETRYABLE_STATUSES:
+                    _REQUEST_LOCAL.failed = attempt
+                raise
+            finally:
+                for hook in REQUEST_HOOKS:
+                    hook(self.host, method, url, time.time() - start, size, status, retry)
+
+    PooledConnection.__name__ = 'PooledRequestsHttpConnection'
+    PooledRequestsHttpConnection = PooledConnection
+    return PooledRequestsHttpConnection
+
+
+def retryable_error(method, error):
+    '''True if a request which failed with the given TransportError may be sent again.'''
+    if error.status_code == 429:
+        return True
+    if method not in IDEMPOTENT_METHODS:
+        return False
+    return isinstance(error, exceptions.ConnectionError) or error.status_code in RETRYABLE_STATUSES
+
+
+class TokenBucket(object):
+    '''A thread-safe token bucket rate limiter: allows `rate` requests per second on average,
+    in bursts of up to `burst` requests.'''
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or max(1, rate))
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        '''Blocks until a token is available, then takes it.'''
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def retrying_transport_class():
+    '''Returns RetryingTransport, an elasticsearch Transport which retries failed requests
+    with jittered exponential backoff, and optionally rate limits them with a TokenBucket.
+
+    Only retryable_error() failures are retried, up to request_retries times; this replaces
+    the stock retry loop, which retries any method straight away. Like
+    pooled_connection_class(), the class is defined on first use.
+    '''
+    global RetryingTransport
+    if RetryingTransport is not None:
+        return RetryingTransport
+
+    class Retrying(elasticsearch.Transport):
+        def __init__(self, hosts, request_retries=REQUEST_RETRIES, rate_limit=None,
+                     rate_burst=None, **kwargs):
+            kwargs['max_retries'] = 0
+            super(Retrying, self).__init__(hosts, **kwargs)
+            self.request_retries = request_retries
+            self.rate_limiter = TokenBucket(rate_limit, rate_burst) if rate_limit else None
+
+        def perform_request(self, method, url, params=None, body=None):
+            for attempt in range(self.request_retries + 1):
+                if self.rate_limiter is not None:
+                    self.rate_limiter.acquire()
+                try:
+                    # the stock transport pops its own options out of params
+                    return super(Retrying, self).perform_request(
+                        method, url, dict(params) if params else params, body)
+                except exceptions.TransportError as e:
+                    if attempt == self.request_retries or not retryable_error(method, e):
+                        raise
+                time.sleep(random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt)))
+
+    Retrying.__name__ = 'RetryingTransport'
+    RetryingTransport = Retrying
+    return RetryingTransport
+
+
+def request_endpoint(method, url):
+    '''Returns a request's endpoint, with index/repo/snapshot names replaced by '*', i.e.
+    "GET /_snapshot/*/*/_status" or "GET /_cat/snapshots/*".'''
+    parts = url.split('?')[0].split('/')
+    for i in range(len(parts)):
+        if parts[i] != '' and not parts[i].startswith('_') and \
+                (i == 0 or parts[i - 1] not in ('_cat', '_cluster', '_nodes')):
+            parts[i] = '*'
+    return "%s %s" % (method, '/'.join(parts) or '/')
+
+
+class RequestStats(object):
+    '''A request hook which keeps per-cluster, per-endpoint latency histograms, response
+    sizes and error/retry counts.
+
+    Install it with REQUEST_HOOKS.append(stats.record).
+    '''
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.endpoints = {}
+        self.lock = threading.Lock()
+
+    def record(self, host, method, url, seconds, size, status, retry):
+        cluster = re.sub(r'^\w+://|:\d+$', '', host)
+        key = (cluster, request_endpoint(method, url))
+        with self.lock:
+            stats = self.endpoints.get(key)
+            if stats is None:
+                stats = {'count': 0, 'seconds': 0.0, 'max': 0.0, 'bytes': 0, 'errors': 0,
+                         'retries': 0, 'buckets': [0] * len(self.buckets)}
+                self.endpoints[key] = stats
+            stats['count'] += 1
+            stats['seconds'] += seconds
+            stats['max'] = max(stats['max'], seconds)
+            stats['bytes'] += size
+            if not isinstance(status, int) or status >= 400:
+                stats['errors'] += 1
+            if retry:
+                stats['retries'] += 1
+            for (i, bound) in enumerate(self.buckets):
+                if seconds <= bound:
+                    stats['buckets'][i] += 1
+                    break
+
+    def __quantile(self, stats, q):
+        '''Returns the upper bound of the histogram bucket holding the q-th quantile.'''
+        seen = 0
+        for (bound, count) in zip(self.buckets, stats['buckets']):
+            seen += count
+            if seen >= q * stats['count']:
+                return min(bound, stats['max'])
+        return stats['max']
+
+    def summary(self):
+        '''Returns [(cluster, endpoint, stats), ...], slowest (by total time) first. Each stats
+        dict also holds the endpoint's estimated 95th percentile latency, as 'p95'.'''
+        with self.lock:
+            endpoints = [(k, dict(v)) for (k, v) in self.endpoints.items()]
+        rows = []
+        for ((cluster, endpoint), stats) in sorted(endpoints, key=lambda e: -e[1]['seconds']):
+            stats['p95'] = self.__quantile(stats, 0.95)
+            rows.append((cluster, endpoint, stats))
+        return rows
+
+    def prometheus_lines(self):
+        '''Returns the stats as Prometheus metric lines; see write_prometheus_textfile().'''
+        with self.lock:
+            endpoints = sorted((k, dict(v)) for (k, v) in self.endpoints.items())
+        lines = ['# TYPE esbackup_request_duration_seconds histogram',
+                 '# TYPE esbackup_response_bytes_total counter',
+                 '# TYPE esbackup_request_errors_total counter',
+                 '# TYPE esbackup_request_retries_total counter']
+        for ((cluster, endpoint), stats) in endpoints:
+            labels = 'cluster="%s",endpoint="%s"' % (cluster, endpoint)
+            cumulative = 0
+            for (bound, count) in zip(self.buckets, stats['buckets']):
+                cumulative += count
+                lines.append('esbackup_request_duration_seconds_bucket{%s,le="%s"} %i' % (labels, bound, cumulative))
+            lines.append('esbackup_request_duration_seconds_bucket{%s,le="+Inf"} %i' % (labels, stats['count']))
+            lines.append('esbackup_request_duration_seconds_sum{%s} %f' % (labels, stats['seconds']))
+            lines.append('esbackup_request_duration_seconds_count{%s} %i' % (labels, stats['count']))
+            lines.append('esbackup_response_bytes_total{%s} %i' % (labels, stats['bytes']))
+            lines.append('esbackup_request_errors_total{%s} %i' % (labels, stats['errors']))
+            lines.append('esbackup_request_retries_total{%s} %i' % (labels, stats['retries']))
+        return lines
+
+
+def elasticsearch_connection(cluster, username, password, ca_cert_path, pool_maxsize=POOL_MAXSIZE):
+    '''Return an elasticsearch connection object for the cluster.
+
+    Clients are cached per cluster, so repeated calls reuse the same keep-alive connection
+    pool and SigV4 signer (AWS4Auth regenerates its signing key itself once the key's date
+    scope expires). The cluster is only pinged if it hasn't passed a health check within
+    HEALTH_CHECK_TTL seconds.
+
+    Requests are sent through a RetryingTransport. A cluster's optional 'max_retries',
+    'rate_limit' (requests/second) and 'rate_burst' config keys tune its retries and its
+    client-side rate limit, which is shared by all threads using the cluster.
+    '''
     required_keys = ['url', 'region']
     for k in required_keys:
         if not cluster.has_key(k):
-            __error_exit("Cluster configuration is missing key [%s]!" % k)
-
-    awsauth = AWS4Auth(username, password, cluster['region'], 'es')
-    es = Elasticsearch(
-        ["https://%s:443/" % cluster['url']],
-        use_ssl=True,
-        verify_certs=True,
-        ca_certs=ca_cert_path,
-        http_auth=awsauth,
-        connection_class=RequestsHttpConnection,
-        timeout=60
-    )
-
-    if not es.ping():
-        __error_exit("Failed to connect to cluster [%s]!" % cluster['url'])
-
-    return es
+            raise EsBackupError("Cluster configuration is missing key [%s]!" % k)
+
+    cache_key = (cluster['url'], cluster['region'], username)
+    with _CLIENTS_LOCK:
+        client = _CLIENTS.get(cache_key)
+        if client is None:
+            awsauth = requests_aws4auth.AWS4Auth(username, password, cluster['region'], 'es')
+            es = elasticsearch.Elasticsearch(
+                ["https://%s:443/" % cluster['url']],
+                use_ssl=True,
+                verify_certs=True,
+                ca_certs=ca_cert_path,
+                http_auth=awsauth,
+                connection_class=pooled_connection_class(),
+                pool_maxsize=pool_maxsize,
+                transport_class=retrying_transport_class(),
+                request_retries=cluster.get('max_retries', REQUEST_RETRIES),
+                rate_limit=cluster.get('rate_limit'),
+                rate_burst=cluster.get('rate_burst'),
+                timeout=60
+            )
+            client = {'es': es, 'last_healthy': 0}
+            _CLIENTS[cache_key] = client
+
+    if time.time() - client['last_healthy'] > HEALTH_CHECK_TTL:
+        if not client['es'].ping():
+            raise EsBackupError("Failed to connect to cluster [%s]!" % cluster['url'])
+        client['last_healthy'] = time.time()
+
+    return client['es']
+
+
+def cluster_version(es):
+    '''Returns the cluster's version number as a tuple of ints, i.e. (2, 3, 0).'''
+    version = _VERSIONS.get(id(es))
+    if version is None:
+        number = es.info()['version']['number']
+        version = tuple(int(v) for v in number.split('-')[0].split('.'))
+        _VERSIONS[id(es)] = version
+    return version
 
 
 def create_snapshot(es, indices, snapshot_name):
-    '''Create a snapshot in the specified repo.'''
+    '''Create a snapshot in the specified repo. Returns {repository, snapshot, started}, where
+    started is False if the snapshot already existed.'''
     try:
         (repo, snap) = snapshot_name.split('/')
     except ValueError:
-        __error_exit("You must specify a snapshot name in the format \"repo_name/snapshot_name\"!")
+        raise EsBackupError("You must specify a snapshot name in the format \"repo_name/snapshot_name\"!")
 
     snapshot_body = "{\"indices\": \"%s\",\"ignore_unavailable\": false}" % indices
 
     try:
         snap_check = es.snapshot.get(repository=repo, snapshot=snap)
-        print "Snapshot [%s] already exists in repo [%s]." % (snap, repo)
-        if OPTS.verbose:
-            print repr(snap_check)
+        __say("Snapshot [%s] already exists in repo [%s]." % (snap, repo))
+        if __verbose():
+            __say(repr(snap_check))
+        return {'repository': repo, 'snapshot': snap, 'started': False}
     except exceptions.NotFoundError:
         es.snapshot.create(repository=repo, snapshot=snap, body=snapshot_body,
                            wait_for_completion=False)
-        print "Started snapshot [%s] in repo [%s]..." % (snap, repo)
+        __say("Started snapshot [%s] in repo [%s]..." % (snap, repo))
+        return {'repository': repo, 'snapshot': snap, 'started': True}
 
 
 def delete_snapshot(es, snapshot_to_delete):
-    '''Delete a snapshot from the specified repo on the specified cluster.'''
+    '''Delete a snapshot from the specified repo on the specified cluster. Returns
+    {repository, snapshot, deleted}.'''
     try:
         (repo, snap) = snapshot_to_delete.split('/')
     except ValueError:
-        __error_exit("You must specify a snapshot name in the format \"repo_name/snapshot_name\"!")
+        raise EsBackupError("You must specify a snapshot name in the format \"repo_name/snapshot_name\"!")
 
     try:
         snap_info = es.snapshot.get(repository=repo, snapshot=snap)
-        if OPTS.verbose:
-            print "Deleting: %s" % snap_info
+        if __verbose():
+            __say("Deleting: %s" % snap_info)
     except exceptions.NotFoundError:
-        __error_exit("Snapshot [%s] could not be found in repo [%s]." % (snap, repo))
+        raise EsBackupError("Snapshot [%s] could not be found in repo [%s]." % (snap, repo))
 
-    try:
-        es.snapshot.delete(repository=repo, snapshot=snap)
-        print "Snapshot [%s] has been deleted from repo [%s]." % (snap, repo)
-    except exceptions.NotFoundError:
-        # A successful deletion can cause NotFoundError to bubble up for some reason.
-        # Let's try to handle that bug gracefully by checking if the delete succeeded.
+    (_, _, err) = __delete_snapshot_batch(es, repo, [snap])
+    if err is not None:
+        raise EsBackupError("Failed to delete snapshot [%s]!\n%s" % (snap, err))
+    __say("Snapshot [%s] has been deleted from repo [%s]." % (snap, repo))
+    return {'repository': repo, 'snapshot': snap, 'deleted': True}
+
+
+def __snapshots_gone(es, repo, names, checks=5):
+    '''Returns True once none of the named snapshots are listed in the repo, checking a
+    few times with a short, growing delay.'''
+    names = set(names)
+    for check in range(checks):
+        if not names.intersection(__list_snapshot_names(es, repo)):
+            return True
+        time.sleep(0.5 * (check + 1))
+    return False
+
+
+def __delete_snapshot_batch(es, repo, names):
+    '''Deletes the named snapshots from a repo in one request.
+
+    Deletes rejected because another snapshot operation is running are retried with
+    exponential backoff. Returns (repo, names, error), where error is None on success.
+    '''
+    for attempt in range(DELETE_RETRIES + 1):
         try:
-            time.sleep(2)
-            # This should throw a NotFoundError if the delete succeeded.
-            snap_info = es.snapshot.get(repository=repo, snapshot=snap)
-            __error_exit("Failed to delete snapshot [%s]!\nSnapshot info: %s" % (snap, snap_info))
+            es.snapshot.delete(repository=repo, snapshot=','.join(names))
+            return (repo, names, None)
         except exceptions.NotFoundError:
-            print "Snapshot [%s] has been deleted from repo [%s]." % (snap, repo)
+            # A successful deletion can cause NotFoundError to bubble up for some reason.
+            # Let's try to handle that bug gracefully by checking if the delete succeeded.
+            if __snapshots_gone(es, repo, names):
+                return (repo, names, None)
+            return (repo, names, "Snapshot(s) still present after delete.")
+        except exceptions.TransportError as e:
+            concurrent = ('ConcurrentSnapshotExecution' in str(e) or
+                          'concurrent_snapshot_execution' in str(e))
+            if not concurrent or attempt == DELETE_RETRIES:
+                return (repo, names, str(e))
+            time.sleep(min(2 ** attempt, 60))
+
+
+def select_snapshots_to_prune(snapshots, keep_last=0, keep_daily=0, keep_monthly=0, now=None):
+    '''Applies retention rules to a repo's snapshots, returning the names to delete
+    (oldest first).
+
+    Only SUCCESS snapshots count towards, and are protected by, the rules:
+      keep_last    -- keep the newest N snapshots
+      keep_daily   -- keep the newest snapshot from each of the last N days (UTC)
+      keep_monthly -- keep the newest snapshot from each of the last N months (UTC)
+    Snapshots which are still in progress are never deleted.
+    '''
+    now = datetime.utcfromtimestamp(time.time() if now is None else now)
+    finished = sorted([s for s in snapshots if s['state'] != 'IN_PROGRESS'],
+                      key=lambda s: s.get('start_time_in_millis', 0), reverse=True)
+    successful = [s for s in finished if s['state'] == 'SUCCESS']
+
+    keep = set(s['snapshot'] for s in successful[:keep_last])
+    first_day = (now - timedelta(days=keep_daily - 1)).date()
+    first_month = (now.year * 12 + now.month - 1) - (keep_monthly - 1)
+    days_kept = set()
+    months_kept = set()
+    for s in successful:
+        started = datetime.utcfromtimestamp(s.get('start_time_in_millis', 0) / 1000)
+        day = started.date()
+        month = started.year * 12 + started.month - 1
+        if keep_daily > 0 and day >= first_day and day not in days_kept:
+            days_kept.add(day)
+            keep.add(s['snapshot'])
+        if keep_monthly > 0 and month >= first_month and month not in months_kept:
+            months_kept.add(month)
+            keep.add(s['snapshot'])
+
+    return [s['snapshot'] for s in reversed(finished) if s['snapshot'] not in keep]
+
+
+def __catalog_forget(cache_file, deleted):
+    '''Drops deleted snapshots ({repo: [names]}) from a cached catalog, if there is one.'''
+    cached = __load_cache(cache_file)
+    if not cached:
+        return
+    for (repo, names) in deleted.items():
+        gone = set(names)
+        cached['repos'][repo] = [s for s in cached['repos'].get(repo, []) if s['snapshot'] not in gone]
+    __save_cache(cache_file, cached)
+
+
+def prune_snapshots(es, keep_last=0, keep_daily=0, keep_monthly=0, repos=None, pattern='*',
+                    catalog_file=None, ttl=CATALOG_TTL, dry_run=False, workers=1):
+    '''Deletes all snapshots not kept by the given retention rules.
+
+    The delete set is computed from a single catalog fetch. Deletes run on a pool of up to
+    `workers` threads; clusters older than 7.8 only allow one snapshot deletion at a time,
+    so there deletes are serialized and one snapshot is deleted per request. Newer clusters
+    get multi-snapshot deletes of up to DELETE_BATCH_SIZE names.
+
+    Returns {planned, deleted, failed, errors, dry_run}, each of planned/deleted/failed being
+    a dict of {repo: [snapshot_name, ...]}, and errors a list of {repository, snapshots, error}
+    for each failed delete request.
+    '''
+    if not (keep_last or keep_daily or keep_monthly):
+        raise EsBackupError("Refusing to prune without at least one --keep-* retention rule!")
+
+    catalog = snapshot_catalog(es, catalog_file, ttl)
+    plan = {}
+    for r in sorted(catalog.keys()):
+        if repos and r not in repos:
+            continue
+        matched = [s for s in catalog[r] if fnmatch.fnmatchcase(s['snapshot'], pattern)]
+        doomed = select_snapshots_to_prune(matched, keep_last, keep_daily, keep_monthly)
+        __say("Repo [%s]: %i snapshots matched, %i to delete." % (r, len(matched), len(doomed)))
+        if __verbose() or dry_run:
+            for name in doomed:
+                __say("   %s" % name)
+        if doomed:
+            plan[r] = doomed
+
+    result = {'planned': plan, 'deleted': {}, 'failed': {}, 'errors': [], 'dry_run': dry_run}
+    if dry_run or not plan:
+        __say("Nothing deleted.")
+        return result
+
+    if cluster_version(es) >= (7, 8):
+        batch_size = DELETE_BATCH_SIZE
+    else:
+        (batch_size, workers) = (1, 1)
+    batches = []
+    for (r, names) in plan.items():
+        for i in range(0, len(names), batch_size):
+            batches.append((r, names[i:i + batch_size]))
+
+    (deleted, failed) = (result['deleted'], result['failed'])
+    pool = ThreadPool(max(1, min(workers, len(batches))))
+    try:
+        for (r, names, err) in pool.imap_unordered(lambda b: __delete_snapshot_batch(es, *b), batches):
+            if err is None:
+                deleted.setdefault(r, []).extend(names)
+                __say("Deleted from repo [%s]: %s" % (r, ', '.join(names)))
+            else:
+                failed.setdefault(r, []).extend(names)
+                result['errors'].append({'repository': r, 'snapshots': names, 'error': str(err)})
+                __say_error("Failed to delete from repo [%s]: %s\n%s" % (r, ', '.join(names), err))
+    finally:
+        pool.close()
+        if catalog_file:
+            __catalog_forget(catalog_file, deleted)
+
+    __say("Deleted %i snapshot(s)." % sum(len(names) for names in deleted.values()))
+    return result
 
 
 def create_repo(es, repo_name, bucket, bucket_region, s3_role_arn, read_only='false'):
-    '''Create an ElasticSearch snapshot repository within the given cluster.'''
+    '''Create an ElasticSearch snapshot repository within the given cluster. Returns
+    {repository, created}.'''
     repo_body = ''.join(['{"type": "s3","settings": {',
                          '"bucket": "{}", "region": "{}",'.format(bucket, bucket_region),
                          '"role_arn": "{}", '.format(s3_role_arn),
@@ -127,157 +973,1256 @@ def create_repo(es, repo_name, bucket, bucket_region, s3_role_arn, read_only='fa
                          '}}'])
 
     es.snapshot.create_repository(repository=repo_name, body=repo_body)
-    print "Repo [%s] has been created." % repo_name
-    if OPTS.verbose:
-        print es.snapshot.get_repository(repository=repo_name)
+    __say("Repo [%s] has been created." % repo_name)
+    if __verbose():
+        __say(es.snapshot.get_repository(repository=repo_name))
+    return {'repository': repo_name, 'created': True}
 
 
 def delete_repo(es, repo_to_delete):
-    '''Remove a repository from the specified cluster.'''
+    '''Remove a repository from the specified cluster. Returns {repository, deleted}.'''
     try:
-        if OPTS.verbose:
-            print "Removing Repository: %s" % es.snapshot.get_repository(repository=repo_to_delete)
+        if __verbose():
+            __say("Removing Repository: %s" % es.snapshot.get_repository(repository=repo_to_delete))
 
         es.snapshot.delete_repository(repository=repo_to_delete)
-        print "Repo [%s] has been deleted." % repo_to_delete
+        __say("Repo [%s] has been deleted." % repo_to_delete)
+        return {'repository': repo_to_delete, 'deleted': True}
     except exceptions.NotFoundError:
-        __error_exit("Repository [%s] could not be found." % repo_to_delete)
+        raise EsBackupError("Repository [%s] could not be found." % repo_to_delete)
 
 
-def restore_snapshot(es, src_snapshot, indices, rename_pattern, rename_replacement):
-    '''Restores the specified source repo/snapshot using the specified rename_* options.'''
+def restore_snapshot(es, src_snapshot, indices, rename_pattern, rename_replacement,
+                     index_settings=None):
+    '''Restores the specified source repo/snapshot using the specified rename_* options.
+
+    index_settings (a dict, i.e. {"index.number_of_replicas": 0}) is applied to the restored
+    indices, which lets restores skip building replicas while recovering.
+
+    Returns {repository, snapshot, accepted}.
+    '''
     try:
         (repo, snap) = src_snapshot.split('/')
     except ValueError:
-        __error_exit("You must specify the src_snapshot in the format \"repo_name/snapshot_name\"!")
+        raise EsBackupError("You must specify the src_snapshot in the format \"repo_name/snapshot_name\"!")
 
-    if rename_pattern == '' and rename_replacement == '':
-        # indices will be restored with their original unmodified names
-        restore_body = ''.join(['{',
-                                '"indices": "{}","ignore_unavailable": false,'.format(indices),
-                                '"include_global_state": false}'])
-    else:
+    restore_body = {'indices': indices, 'ignore_unavailable': False, 'include_global_state': False}
+    if rename_pattern != '' or rename_replacement != '':
         # indices will be restored with replacement names, using the
         # rename_{pattern,replacement} option values
-        restore_body = ''.join(['{',
-                                '"indices": "{}",'.format(indices),
-                                '"ignore_unavailable": false,"include_global_state": false,',
-                                '"rename_pattern": "{}",'.format(rename_pattern),
-                                '"rename_replacement": "{}"'.format(rename_replacement),
-                                '}'])
-
-    restore_resp = es.snapshot.restore(repository=repo, snapshot=snap, body=restore_body,
+        restore_body['rename_pattern'] = rename_pattern
+        restore_body['rename_replacement'] = rename_replacement
+    if index_settings:
+        restore_body['index_settings'] = index_settings
+
+    restore_resp = es.snapshot.restore(repository=repo, snapshot=snap, body=json.dumps(restore_body),
                                        wait_for_completion=False)
-    print "Snapshot [%s] restoration has begun!" % src_snapshot
-    if OPTS.verbose:
-        print "ElasticSearch Response: %s" % restore_resp
+    __say("Snapshot [%s] restoration has begun!" % src_snapshot)
+    if __verbose():
+        __say("ElasticSearch Response: %s" % restore_resp)
+    return {'repository': repo, 'snapshot': snap, 'accepted': bool(restore_resp.get('accepted', True))}
+
+
+def __expand_index_patterns(names, patterns):
+    '''Returns the names matched by a comma-separated index expression, as ES resolves it:
+    patterns are applied in order, and a pattern prefixed with '-' removes the names it
+    matches from those matched so far.'''
+    matched = []
+    for p in patterns.split(','):
+        p = p.strip()
+        if p in ('', '_all'):
+            p = '*'
+        if p.startswith('-') and matched:
+            matched = [i for i in matched if not fnmatch.fnmatchcase(i, p[1:])]
+        else:
+            matched.extend(i for i in names if fnmatch.fnmatchcase(i, p.lstrip('+')) and i not in matched)
+    return matched
+
+
+def restored_index_names(es, src_snapshot, indices, rename_pattern='', rename_replacement=''):
+    '''Returns the names the snapshot's indices will have once restored with these options.'''
+    (repo, snap) = src_snapshot.split('/')
+    snap_info = es.snapshot.get(repository=repo, snapshot=snap)['snapshots'][0]
+    names = __expand_index_patterns(snap_info['indices'], indices)
+    if rename_pattern != '':
+        # ES uses java regex replacement syntax, i.e. "$1"
+        replacement = re.sub(r'\$(\d+)', r'\\g<\1>', rename_replacement)
+        names = [re.sub(rename_pattern, replacement, i) for i in names]
+    return sorted(names)
+
+
+def recovery_progress(es, index_names):
+    '''Returns {index_name: (recovered_bytes, total_bytes, recovered_files, total_files, done)}
+    for the given indices, summed over their shards from the _recovery API. Indices which the
+    cluster has no recovery of (i.e. which don't exist) are left out.'''
+    recovery = es.indices.recovery(index=','.join(index_names), params={'ignore_unavailable': 'true'})
+    progress = {}
+    for index_name in index_names:
+        if index_name not in recovery:
+            continue
+        shards = recovery[index_name].get('shards', [])
+        (rec_bytes, total_bytes, rec_files, total_files) = (0, 0, 0, 0)
+        for shard in shards:
+            rec_bytes += shard['index']['size']['recovered_in_bytes']
+            total_bytes += shard['index']['size']['total_in_bytes']
+            rec_files += shard['index']['files']['recovered']
+            total_files += shard['index']['files']['total']
+        done = bool(shards) and all(shard['stage'] == 'DONE' for shard in shards)
+        progress[index_name] = (rec_bytes, total_bytes, rec_files, total_files, done)
+    return progress
+
+
+def failed_shards(es, index_names):
+    '''Returns the "index[shard]" names of the indices' primary shards whose allocation (i.e.
+    restore) failed.'''
+    lines = es.cat.shards(index=','.join(index_names), h='index,shard,prirep,state,unassigned.reason',
+                          v=False)
+    failed = []
+    for line in lines.split('\n'):
+        fields = line.split()
+        if len(fields) == 5 and fields[2] == 'p' and fields[3] == 'UNASSIGNED' and fields[4] == 'ALLOCATION_FAILED':
+            failed.append("%s[%s]" % (fields[0], fields[1]))
+    return failed
+
+
+def watch_restore(es, index_names, interval=RESTORE_POLL_INTERVAL, final_replicas=None,
+                  aliases=None, timeout=RESTORE_TIMEOUT):
+    '''Blocks until the restored indices have recovered, reporting per-index and overall
+    progress. Then optionally sets their final replica count, waits for them to go green,
+    and adds the given aliases to them.
+
+    Raises EsBackupError if an index isn't being restored, a primary shard fails to restore,
+    or the whole thing takes longer than timeout seconds.
+
+    Returns {indices, recovered_bytes, elapsed, final_replicas, aliases}.
+    '''
+    start = time.time()
+    deadline = start + timeout
+    last = (start, 0)
+    while True:
+        progress = recovery_progress(es, index_names)
+        missing = [i for i in index_names if i not in progress]
+        if missing:
+            raise EsBackupError("Indices [%s] aren't being restored!" % ','.join(missing))
+        failed = failed_shards(es, index_names)
+        if failed:
+            raise EsBackupError("Failed to restore shard(s) %s!" % ', '.join(failed))
+        total_recovered = 0
+        for index_name in index_names:
+            (rec_bytes, total_bytes, rec_files, total_files, done) = progress[index_name]
+            total_recovered += rec_bytes
+            if __verbose() or not done:
+                __say("   %-40s %s of %s, %i/%i files%s" % (
+                    index_name, __format_bytes(rec_bytes), __format_bytes(total_bytes),
+                    rec_files, total_files, ' (done)' if done else ''))
+
+        now = time.time()
+        rate = (total_recovered - last[1]) / max(now - last[0], 0.001)
+        overall = total_recovered / max(now - start, 0.001)
+        remaining = len([i for i in index_names if not progress[i][4]])
+        __say("[%s] %i/%i indices recovered, %s recovered (%s/s now, %s/s overall)" % (
+            datetime.now().strftime('%H:%M:%S'), len(index_names) - remaining, len(index_names),
+            __format_bytes(total_recovered), __format_bytes(rate), __format_bytes(overall)))
+        last = (now, total_recovered)
+        if remaining == 0:
+            break
+        if now >= deadline:
+            raise EsBackupError("Restore didn't complete within %s!" % timedelta(seconds=int(timeout)))
+        time.sleep(interval)
+
+    if final_replicas is not None:
+        es.indices.put_settings(index=','.join(index_names),
+                                body=json.dumps({'index': {'number_of_replicas': final_replicas}}))
+        __say("Set number_of_replicas to %i on %i restored indices." % (final_replicas, len(index_names)))
+
+    if aliases:
+        while es.cluster.health(index=','.join(index_names))['status'] != 'green':
+            if time.time() >= deadline:
+                raise EsBackupError("Restored indices didn't go green within %s!" % timedelta(seconds=int(timeout)))
+            time.sleep(interval)
+        actions = [{'add': {'index': i, 'alias': a}} for a in aliases for i in index_names]
+        es.indices.update_aliases(body=json.dumps({'actions': actions}))
+        __say("Added alias(es) %s to %i restored indices." % (', '.join(aliases), len(index_names)))
+
+    elapsed = time.time() - start
+    __say("Restore completed in %s." % timedelta(seconds=int(elapsed)))
+    return {'indices': index_names, 'recovered_bytes': total_recovered, 'elapsed': elapsed,
+            'final_replicas': final_replicas, 'aliases': aliases or []}
+
+
+def show_snapshots(es, catalog_file=None, ttl=CATALOG_TTL, repos=None, pattern='*',
+                   since=None, until=None, page_size=SNAPSHOT_PAGE_SIZE, output_format='text'):
+    '''Enumerate all repositories on the cluster and list all (matching) snapshots.
+
+    Rows are printed as they're fetched, and the catalog in catalog_file is kept warm (see
+    listed_snapshots()). output_format is either 'text' (grouped by repo) or 'table'; json and
+    ndjson output go through emit() instead.
+    '''
+    if output_format == 'table':
+        print "%-24s %-40s %-12s %-19s %10s %7s" % ('REPOSITORY', 'SNAPSHOT', 'STATE', 'START',
+                                                  'DURATION', 'INDICES')
+
+    current_repo = None
+    for (r, s) in listed_snapshots(es, catalog_file, ttl, repos, pattern, since, until, page_size):
+        if output_format == 'table':
+            print "%-24s %-40s %-12s %-19s %10s %7i" % (
+                r, s['snapshot'], s['state'], __format_millis(s.get('start_time_in_millis')),
+                timedelta(seconds=s.get('duration_in_millis', 0) / 1000),
+                len(s.get('indices', [])))
+        else:
+            if r != current_repo:
+                if current_repo is not None:
+                    print ""
+                print "=== Snapshots in repo [%s] ===" % r
+            print "   %s (%s)" % (s['snapshot'], s['state'])
+        current_repo = r
+        sys.stdout.flush()
 
+    if current_repo is None:
+        print "No matching snapshots were found."
+    elif output_format == 'text':
+        print ""
 
-def show_snapshots(es):
-    '''Enumerate all repositories on the cluster and list all snapshots.'''
-    repos_raw = es.cat.repositories(v=False)
-    repos = []
-    for line in repos_raw.split('\n'):
-        if line == '':
-            continue
-        repos.append(line.split()[0].strip())
 
-    # skip any AWS-maintained snapshot repos, since we won't have access...
-    for bad_repo in BAD_REPO_NAMES:
-        repos.remove(bad_repo)
+def __status_record(status):
+    '''Condenses a completed snapshot's _status into {start, millis, bytes, processed, indices},
+    where bytes is what the snapshot copied (see snapshot_progress()), and indices holds the
+    same byte and time counts per index.'''
+    (processed, total, elapsed, _, _) = snapshot_progress(status)
+    record = {'start': status.get('stats', {}).get('start_time_in_millis'),
+              'millis': int(elapsed * 1000), 'bytes': total, 'processed': processed,
+              'indices': {}}
+    for (index_name, index_status) in status.get('indices', {}).items():
+        (processed, total, elapsed, _, _) = snapshot_progress(index_status)
+        record['indices'][index_name] = {'millis': int(elapsed * 1000), 'bytes': total,
+                                         'processed': processed}
+    return record
+
+
+def snapshot_stats(es, catalog, cache_file=None, workers=POLL_WORKERS):
+    '''Returns {repo: {snapshot_name: record}} for the successful snapshots in a catalog (see
+    snapshot_catalog()), each record condensed from the snapshot's _status.
+
+    Completed snapshots never change, so records are kept in cache_file (if given) and only
+    snapshots new since the last call are fetched, STATUS_FETCH_BATCH at a time on up to
+    `workers` threads.
+    '''
+    cached = (__load_cache(cache_file) if cache_file else None) or {'repos': {}}
+    stats = {}
+    batches = []
+    for (r, snapshots) in catalog.items():
+        known = cached['repos'].get(r, {})
+        stats[r] = {}
+        fetch = []
+        for s in snapshots:
+            if s['state'] != 'SUCCESS':
+                continue
+            if s['snapshot'] in known:
+                stats[r][s['snapshot']] = known[s['snapshot']]
+            else:
+                fetch.append(s['snapshot'])
+        for i in range(0, len(fetch), STATUS_FETCH_BATCH):
+            batches.append((r, fetch[i:i + STATUS_FETCH_BATCH]))
 
-    if not repos:
-        print "No snapshot repositories were found."
+    def fetch_status(batch):
+        (r, names) = batch
+        return (r, es.snapshot.status(repository=r, snapshot=','.join(names))['snapshots'])
 
-    for r in repos:
-        print "=== Snapshots in repo [%s] ===" % r
+    if batches:
+        pool = ThreadPool(max(1, min(workers, len(batches))))
+        try:
+            for (r, statuses) in pool.imap_unordered(fetch_status, batches):
+                for status in statuses:
+                    stats[r][status['snapshot']] = __status_record(status)
+        finally:
+            pool.close()
+        if __verbose():
+            __say("Fetched _status of %i snapshot(s)." % sum(len(names) for (_, names) in batches))
+
+    if cache_file:
+        # keep the records of repos left out of this catalog, i.e. by a repos filter
+        __save_cache(cache_file, {'updated': time.time(), 'repos': dict(cached['repos'], **stats)})
+    return stats
+
+
+def __slope(points):
+    '''Returns the least-squares slope of a list of (x, y) points, or None for fewer than 2.'''
+    n = len(points)
+    if n < 2:
+        return None
+    mean_x = sum(x for (x, _) in points) / float(n)
+    mean_y = sum(y for (_, y) in points) / float(n)
+    var_x = sum((x - mean_x) ** 2 for (x, _) in points)
+    if var_x == 0:
+        return None
+    return sum((x - mean_x) * (y - mean_y) for (x, y) in points) / var_x
+
+
+def __percentile(values, q):
+    '''Returns the q-th quantile (nearest rank) of a sorted list of values.'''
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def analyze_snapshots(es, catalog_file=None, ttl=CATALOG_TTL, stats_file=None, repos=None,
+                      pattern='*', since=None, until=None, top=ANALYZE_TOP_INDICES,
+                      workers=POLL_WORKERS):
+    '''Reports snapshot durations, throughput and growth per repo, plus the slowest indices.
+
+    Returns {'repos': [...], 'slowest_indices': [...]}. Throughput is the bytes a snapshot
+    copied per second. Trends are least-squares slopes over the snapshots' start times, per
+    day: throughput_trend in bytes/s and growth in bytes. The snapshot filters are as for
+    iter_snapshots(), and stats_file caches the _status of completed snapshots.
+    '''
+    catalog = snapshot_catalog(es, catalog_file, ttl)
+    if repos:
+        catalog = dict((r, catalog[r]) for r in repos if r in catalog)
+    stats = snapshot_stats(es, catalog, stats_file, workers)
+
+    report = {'repos': [], 'slowest_indices': []}
+    indices = {}
+    for r in sorted(stats):
+        records = sorted((rec for (name, rec) in stats[r].items()
+                          if __snapshot_matches(name, rec['start'], pattern, since, until)),
+                         key=lambda rec: rec['start'])
+        if not records:
+            continue
+        durations = sorted(rec['millis'] / 1000.0 for rec in records)
+        rates = [(rec['start'] / 86400000.0, rec['processed'] / (rec['millis'] / 1000.0))
+                 for rec in records if rec['millis'] > 0]
+        sizes = [(rec['start'] / 86400000.0, rec['bytes']) for rec in records]
+        total_seconds = sum(durations)
+        report['repos'].append({
+            'repository': r,
+            'snapshots': len(records),
+            'first': records[0]['start'],
+            'last': records[-1]['start'],
+            'latest_bytes': records[-1]['bytes'],
+            'processed_bytes': sum(rec['processed'] for rec in records),
+            'avg_seconds': total_seconds / len(durations),
+            'p95_seconds': __percentile(durations, 0.95),
+            'max_seconds': durations[-1],
+            'avg_throughput': sum(rec['processed'] for rec in records) / total_seconds if total_seconds else 0,
+            'throughput_trend': __slope(rates),
+            'growth_per_day': __slope(sizes),
+        })
+
+        for rec in records:
+            for (index_name, index_rec) in rec['indices'].items():
+                agg = indices.setdefault((r, index_name), [0, 0, 0, 0])
+                agg[0] += 1
+                agg[1] += index_rec['millis']
+                agg[2] = max(agg[2], index_rec['millis'])
+                agg[3] += index_rec['processed']
+
+    slowest = sorted(indices.items(), key=lambda i: (-float(i[1][1]) / i[1][0], i[0]))[:top]
+    for ((r, index_name), (count, millis, max_millis, processed)) in slowest:
+        report['slowest_indices'].append({
+            'repository': r, 'index': index_name, 'snapshots': count,
+            'avg_seconds': millis / 1000.0 / count, 'max_seconds': max_millis / 1000.0,
+            'avg_throughput': processed / (millis / 1000.0) if millis else 0})
+    return report
+
+
+def show_snapshot_analysis(report):
+    '''Prints the report returned by analyze_snapshots() as tables.'''
+    if not report['repos']:
+        print "No matching snapshots were found."
+        return
 
-        snap_data = es.snapshot.get(repository=r, snapshot='*')
-        for s in snap_data['snapshots']:
-            print "   %s (%s)" % (s['snapshot'], s['state'])
+    def trend(value, fmt):
+        if value is None:
+            return '-'
+        return ('+' if value >= 0 else '-') + fmt(abs(value))
+
+    print "%-24s %6s %10s %9s %9s %9s %11s %12s %12s" % (
+        'REPOSITORY', 'SNAPS', 'SIZE', 'AVG', 'P95', 'MAX', 'RATE', 'RATE/DAY', 'GROWTH/DAY')
+    for repo in report['repos']:
+        print "%-24s %6i %10s %9s %9s %9s %11s %12s %12s" % (
+            repo['repository'], repo['snapshots'], __format_bytes(repo['latest_bytes']),
+            timedelta(seconds=int(repo['avg_seconds'])), timedelta(seconds=int(repo['p95_seconds'])),
+            timedelta(seconds=int(repo['max_seconds'])), __format_bytes(repo['avg_throughput']) + '/s',
+            trend(repo['throughput_trend'], lambda v: __format_bytes(v) + '/s'),
+            trend(repo['growth_per_day'], __format_bytes))
+
+    if report['slowest_indices']:
         print ""
+        print "%-24s %-40s %6s %9s %9s %11s" % ('REPOSITORY', 'INDEX', 'SNAPS', 'AVG', 'MAX', 'RATE')
+        for index in report['slowest_indices']:
+            print "%-24s %-40s %6i %9s %9s %11s" % (
+                index['repository'], index['index'], index['snapshots'],
+                timedelta(seconds=int(index['avg_seconds'])), timedelta(seconds=int(index['max_seconds'])),
+                __format_bytes(index['avg_throughput']) + '/s')
 
 
-def show_aliases(es):
-    '''Prints a listing of all aliases, along with the indexes they were found in.'''
-    aliases_raw = es.indices.get_alias(index='*', name='*', allow_no_indices=True,
-                                       expand_wildcards='all', ignore_unavailable=True)
-    if not aliases_raw.keys():
-        print "No aliases were found."
+def alias_maps(es, name='*'):
+    '''Returns ({alias: [index, ...]}, {index: [alias, ...]}) for all aliases matching name,
+    built in a single pass over the alias/index columns of _cat/aliases.'''
+    aliases = {}
+    indices = {}
+    for line in es.cat.aliases(name=name, h='alias,index', v=False).split('\n'):
+        fields = line.split()
+        if len(fields) < 2:
+            continue
+        aliases.setdefault(fields[0], []).append(fields[1])
+        indices.setdefault(fields[1], []).append(fields[0])
+    return (aliases, indices)
+
+
+def alias_map(es):
+    '''Returns a dict of {alias_name: [index_name, ...]} for all aliases on the cluster.'''
+    return alias_maps(es)[0]
+
+
+def alias_view(es, alias=None, index=None, dangling=False, cache_file=None, ttl=CATALOG_TTL):
+    '''Returns the data behind show_aliases: a sorted list of the indices no alias points to
+    if dangling, else a dict of {index: [alias, ...]} if index is given, else a dict of
+    {alias: [index, ...]}.
+
+    alias (a name or wildcard) limits the listing to matching aliases; index instead lists
+    the aliases of matching indices; dangling lists the indices no alias points to. Filters
+    are pushed to the cluster unless cache_file is given, in which case the alias maps are
+    built once and answered from disk for up to ttl seconds.
+    '''
+    cached = __load_cache(cache_file) if cache_file else None
+    if cached and time.time() - cached['updated'] < ttl:
+        (aliases, indices) = (cached['aliases'], cached['indices'])
+    elif cache_file or dangling or (alias is None and index is None):
+        (aliases, indices) = alias_maps(es)
+        if cache_file:
+            __save_cache(cache_file, {'updated': time.time(), 'aliases': aliases, 'indices': indices})
+    elif alias is not None:
+        (aliases, indices) = alias_maps(es, alias)
+    else:
+        aliases_raw = es.indices.get_alias(index=index, allow_no_indices=True,
+                                           expand_wildcards='all', ignore_unavailable=True)
+        (aliases, indices) = ({}, {})
+        for (index_name, data) in aliases_raw.items():
+            indices[index_name] = data['aliases'].keys()
+
+    if dangling:
+        all_indices = [i.strip() for i in es.cat.indices(h='index', v=False).split('\n') if i.strip() != '']
+        return sorted(i for i in all_indices if not indices.get(i))
+
+    if index is not None:
+        return dict((i, sorted(indices[i])) for i in indices
+                    if fnmatch.fnmatchcase(i, index) and indices[i])
+
+    return dict((a, aliases[a]) for a in aliases if alias is None or fnmatch.fnmatchcase(a, alias))
+
+
+def show_aliases(es, alias=None, index=None, dangling=False, cache_file=None, ttl=CATALOG_TTL):
+    '''Prints a listing of all aliases, along with the indexes they were found in. See
+    alias_view() for the filter options.'''
+    view = alias_view(es, alias, index, dangling, cache_file, ttl)
+    if dangling:
+        if not view:
+            print "No indices without aliases were found."
+        for i in view:
+            print i
         return
 
-    aliases = {}
-    for index_name in aliases_raw.keys():
-        for alias in aliases_raw[index_name]['aliases'].keys():
-            try:
-                aliases[alias].append(index_name)
-            except KeyError:
-                aliases[alias] = [index_name]
-    for alias in aliases:
-        print "%s: %s" % (alias, aliases[alias])
+    if not view:
+        print "No aliases were found."
+    for name in sorted(view):
+        print "%s: %s" % (name, view[name])
 
 
 def create_alias(es, alias, indices):
-    '''Creates an alias for the given indices.'''
-    index_list = indices.split(",")
-    index_cnt = len(index_list)
-
-    put_body = "{\"actions\": ["
-    for index in index_list:
-        put_body = put_body + "{\"add\": {\"index\": \"%s\", \"alias\": \"%s\"}}" % (index, alias)
-        index_cnt -= 1
-        if index_cnt > 0:
-            put_body = put_body + ','
-    put_body = put_body + "]}"
-    if OPTS.verbose:
-        print "Creating alias: %s" % put_body
-    put_resp = es.indices.put_alias(index=indices, name=alias, body=put_body)
-    print "Alias created: %s ==> %s" % (alias, indices)
-    if OPTS.verbose:
-        print put_resp
+    '''Creates an alias for the given indices. Returns {alias, indices, acknowledged}.'''
+    put_body = json.dumps({'actions': [{'add': {'index': index, 'alias': alias}}
+                                       for index in indices.split(",")]})
+    if __verbose():
+        __say("Creating alias: %s" % put_body)
+    put_resp = es.indices.update_aliases(body=put_body)
+    __say("Alias created: %s ==> %s" % (alias, indices))
+    if __verbose():
+        __say(put_resp)
+    return {'alias': alias, 'indices': indices.split(','),
+            'acknowledged': bool(put_resp.get('acknowledged'))}
+
+
+def alias_swap_actions(current, mappings):
+    '''Returns the _aliases actions which point each alias in mappings
+    ({alias: [index, ...]}) at exactly the given indices, given the current alias map.
+
+    Indices may be wildcard patterns; an alias is only removed from an index which none of
+    its new patterns match.
+    '''
+    actions = []
+    for alias in sorted(mappings.keys()):
+        targets = mappings[alias]
+        existing = current.get(alias, [])
+        for index in sorted(existing):
+            if not any(fnmatch.fnmatchcase(index, t) for t in targets):
+                actions.append({'remove': {'index': index, 'alias': alias}})
+        for index in targets:
+            if index not in existing:
+                actions.append({'add': {'index': index, 'alias': alias}})
+    return actions
+
+
+def read_alias_mappings(mapping_file, pairs=None):
+    '''Reads alias mappings from a yaml file ("alias: index" or "alias: [index, ...]"; use
+    "-" for stdin) and/or "alias=index1,index2" strings. Returns {alias: [index, ...]}.'''
+    mappings = {}
+    if mapping_file:
+        if mapping_file == '-':
+            raw = yaml.safe_load(sys.stdin)
+        else:
+            with open(mapping_file, 'r') as fp:
+                raw = yaml.safe_load(fp)
+        if not isinstance(raw, dict):
+            raise EsBackupError("Alias mapping file [%s] must contain a mapping of alias: index(es)!" % mapping_file)
+        for (alias, indices) in raw.items():
+            if isinstance(indices, basestring):
+                indices = indices.split(',')
+            mappings[str(alias)] = [str(i) for i in indices]
+
+    for pair in pairs or []:
+        try:
+            (alias, indices) = pair.split('=', 1)
+        except ValueError:
+            raise EsBackupError("Alias mappings must be in the format \"alias=index1,index2\"! Got [%s]." % pair)
+        mappings[alias] = indices.split(',')
+    return mappings
+
+
+def swap_aliases(es, mappings, dry_run=False):
+    '''Atomically repoints many aliases in a single _aliases request. Returns
+    {actions, applied}.'''
+    actions = alias_swap_actions(alias_map(es), mappings)
+    if not actions:
+        __say("All %i alias(es) are already up to date." % len(mappings))
+        return {'actions': [], 'applied': False}
+
+    for action in actions:
+        for (verb, target) in action.items():
+            __say("   %-6s %s ==> %s" % (verb, target['alias'], target['index']))
+    if dry_run:
+        __say("Dry run; %i alias action(s) not applied." % len(actions))
+        return {'actions': actions, 'applied': False}
+
+    resp = es.indices.update_aliases(body=json.dumps({'actions': actions}))
+    __say("Applied %i alias action(s) across %i alias(es)." % (len(actions), len(mappings)))
+    if __verbose():
+        __say(resp)
+    return {'actions': actions, 'applied': True}
 
 
 def delete_alias(es, alias, indices):
-    '''Deletes an alias from the specified indices.'''
+    '''Deletes an alias from the specified indices. Returns {alias, indices, acknowledged}.'''
     delete_resp = es.indices.delete_alias(index=indices, name=alias)
-    if OPTS.verbose:
-        print delete_resp
-    print "Alias [%s] has been removed from indices [%s]." % (alias, indices)
+    if __verbose():
+        __say(delete_resp)
+    __say("Alias [%s] has been removed from indices [%s]." % (alias, indices))
+    return {'alias': alias, 'indices': indices.split(','),
+            'acknowledged': bool(delete_resp.get('acknowledged'))}
 
 
 def delete_index(es, index_name):
     '''Deletes the specified index from the cluster.'''
-    delete_resp = es.indices.delete(index=index_name)
-    print "Index [%s] has been deleted." % index_name
-    if OPTS.verbose:
-        print delete_resp
+    return delete_indices(es, [index_name])
+
 
+def parse_bytes(value):
+    '''Converts a size string such as "512", "10kb" or "1.5gb" to a number of bytes.'''
+    units = [('tb', 1024 ** 4), ('gb', 1024 ** 3), ('mb', 1024 ** 2), ('kb', 1024), ('b', 1)]
+    value = str(value).strip().lower()
+    try:
+        for (suffix, multiplier) in units:
+            if value.endswith(suffix):
+                return int(float(value[:-len(suffix)]) * multiplier)
+        return int(float(value))
+    except ValueError:
+        raise EsBackupError("Invalid size [%s]! Expected a number of bytes, or i.e. '10gb'." % value)
+
+
+def __parse_cat_rows(text, columns):
+    '''Yields a dict per row of non-verbose _cat output with the given columns. Cells never
+    contain whitespace, so rows are split on it; empty cells (i.e. the health and sizes of a
+    closed index) must be in the last columns requested, and are left out of the row.'''
+    for line in text.split('\n'):
+        values = line.split()
+        if values:
+            yield dict(zip(columns, values))
+
+
+def iter_indices(es, pattern='*', columns=None, health=None, min_bytes=0, min_docs=0, sort=None):
+    '''Yields a dict of the requested _cat/indices columns for each matching index.
+
+    Only the requested columns (plus any needed for filtering) are fetched, sizes are in
+    bytes, and the index pattern is applied by the cluster. Rows are fetched as JSON on ES >= 5,
+    and as whitespace separated text before that. Health filtering and sorting are also done
+    server-side on clusters which support it (ES >= 5.1); otherwise rows are filtered as
+    they're read, and sorting falls back to buffering all rows.
+    '''
+    columns = list(columns or ['index'])
+    wanted = list(columns)
+    if health and 'health' not in wanted:
+        wanted.append('health')
+    if min_bytes and 'store.size' not in wanted:
+        wanted.append('store.size')
+    if min_docs and 'docs.count' not in wanted:
+        wanted.append('docs.count')
+    sort_column = sort.lstrip('-') if sort else None
+    if sort_column and sort_column not in wanted:
+        wanted.append(sort_column)
+
+    version = cluster_version(es)
+    params = {'bytes': 'b'}
+    server_side = bool(sort or health) and version >= (5, 1)
+    if server_side:
+        if sort:
+            params['s'] = sort_column + (':desc' if sort.startswith('-') else '')
+        if health and len(health) == 1:
+            params['health'] = health[0]
+
+    if version >= (5, 0):
+        params.update({'h': ','.join(wanted), 'format': 'json'})
+        rows = iter(es.cat.indices(index=pattern, params=params))
+    else:
+        # the columns a closed index has no value for go last, health last of all
+        wanted.sort(key=lambda c: (c == 'health', c in INDEX_NUMERIC_COLUMNS))
+        params.update({'h': ','.join(wanted), 'v': 'false'})
+        rows = __parse_cat_rows(es.cat.indices(index=pattern, params=params), wanted)
+
+    def matches(row):
+        if health and row.get('health') not in health:
+            return False
+        if min_bytes and int(row.get('store.size') or 0) < min_bytes:
+            return False
+        if min_docs and int(row.get('docs.count') or 0) < min_docs:
+            return False
+        return True
+
+    rows = (row for row in rows if matches(row))
+    if sort and not server_side:
+        if sort_column in INDEX_NUMERIC_COLUMNS:
+            key = lambda row: int(row.get(sort_column) or 0)
+        else:
+            key = lambda row: row.get(sort_column)
+        rows = iter(sorted(rows, key=key, reverse=sort.startswith('-')))
+
+    for row in rows:
+        yield row
+
+
+def show_indices(es, pattern='*', columns=None, health=None, min_bytes=0, min_docs=0,
+                 sort='index'):
+    '''Prints a listing of all (matching) indices in the cluster, via _cat/indices.
+
+    With the default single 'index' column, this prints just the index names. Otherwise a
+    table of the requested columns is printed; rows are printed as they're parsed. json and
+    ndjson output go through emit() instead.
+    '''
+    columns = columns or ['index']
+    found = False
+    for row in iter_indices(es, pattern, columns, health, min_bytes, min_docs, sort):
+        if not found and len(columns) > 1:
+            print ' '.join("%-30s" % c if c == 'index' else "%14s" % c for c in columns)
+        found = True
+        cells = []
+        for c in columns:
+            if c == 'index':
+                cells.append("%-30s" % row.get(c))
+            elif c in INDEX_SIZE_COLUMNS and row.get(c):
+                cells.append("%14s" % __format_bytes(int(row[c])))
+            else:
+                cells.append("%14s" % row.get(c))
+        print ' '.join(cells).rstrip()
 
-def show_indices(es):
-    '''Prints a listing of all indices in the cluster.'''
-    indices_raw = es.indices.get(index='*')
-    if not indices_raw.keys():
+    if not found:
         print "No indices were found."
         return
-
-    for i in sorted(indices_raw.keys()):
-        print i
     print ""
 
 
-def watch_snapshot(es):
-    '''Blocks until snapshot completion.'''
+def plan_index_deletion(es, patterns, older_than_days=None):
+    '''Expands index names/patterns (and an optional age rule) into a concrete, sorted list of
+    (index_name, store_size_bytes) tuples to delete. Index names are exactly as _cat/indices
+    returned them; with an age rule, indices whose creation date is unknown are left out.'''
+    rows = iter_indices(es, ','.join(patterns), columns=['index', 'store.size'])
+    sizes = {}
+    for row in rows:
+        if not row.get('index') or len(row['index'].split()) != 1:
+            raise EsBackupError("Unexpected _cat/indices row %s! Not deleting anything." % row)
+        sizes[row['index']] = int(row.get('store.size') or 0)
+
+    if older_than_days is not None and sizes:
+        cutoff = (time.time() - older_than_days * 86400) * 1000
+        settings = es.indices.get_settings(index=','.join(patterns), name='index.creation_date')
+        old_enough = set(index_name for (index_name, data) in settings.items()
+                         if int(data['settings']['index']['creation_date']) <= cutoff)
+        sizes = dict((i, size) for (i, size) in sizes.items() if i in old_enough)
+
+    return sorted(sizes.items())
+
+
+def __index_batches(names, max_chars=DELETE_INDEX_BATCH_CHARS):
+    '''Splits index names into lists whose comma-joined length stays within max_chars.'''
+    batches = []
+    batch = []
+    length = 0
+    for name in names:
+        if batch and length + len(name) + 1 > max_chars:
+            batches.append(batch)
+            (batch, length) = ([], 0)
+        batch.append(name)
+        length += len(name) + 1
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def delete_indices(es, index_names, batch_chars=DELETE_INDEX_BATCH_CHARS, workers=2):
+    '''Deletes the named indices in comma-joined batches, with up to `workers` delete
+    requests in flight at once. Returns {deleted: [index, ...], failed: [index, ...], errors},
+    errors being a list of {indices, error} for each failed delete request.'''
+    def delete(batch):
+        try:
+            return (batch, es.indices.delete(index=','.join(batch)), None)
+        except exceptions.TransportError as e:
+            return (batch, None, e)
+
+    batches = __index_batches(index_names, batch_chars)
+    result = {'deleted': [], 'failed': [], 'errors': []}
+    pool = ThreadPool(max(1, min(workers, len(batches))))
+    try:
+        for (batch, resp, err) in pool.imap_unordered(delete, batches):
+            if err is not None:
+                result['failed'].extend(batch)
+                result['errors'].append({'indices': batch, 'error': str(err)})
+                __say_error("Failed to delete indices [%s]: %s" % (','.join(batch), err))
+                continue
+            result['deleted'].extend(batch)
+            for index_name in batch:
+                __say("Index [%s] has been deleted." % index_name)
+            if __verbose():
+                __say(resp)
+    finally:
+        pool.close()
+    return result
+
+
+def watch_snapshot(es, workers=POLL_WORKERS, min_interval=MIN_POLL_INTERVAL,
+                   max_interval=MAX_POLL_INTERVAL):
+    '''Blocks until snapshot completion, reporting progress and adapting the poll interval.
+    Returns {elapsed, polls, avg_poll_time, max_poll_time}.'''
+    repos = __list_repos(es)
+    poll_times = []
+    last_sample = {}
     in_progress = True
     start_time = datetime.now()
     while in_progress:
-        in_progress = __snapshot_running(es)
-        sys.stdout.write(".")
-        sys.stdout.flush()
-        time.sleep(30)
+        (running, poll_time) = poll_snapshot_status(es, repos, workers)
+        in_progress = bool(running)
+        poll_times.append(poll_time)
+        if not in_progress:
+            break
+
+        interval = max_interval
+        for snap in running:
+            (processed, total, elapsed, done, shards) = snapshot_progress(snap)
+            snap_id = "%s/%s" % (snap['repository'], snap['snapshot'])
+
+            # prefer the rate since the last poll, falling back to the snapshot's average
+            throughput = processed / elapsed if elapsed > 0 else 0
+            if snap_id in last_sample:
+                (prev_processed, prev_elapsed) = last_sample[snap_id]
+                if elapsed > prev_elapsed and processed > prev_processed:
+                    throughput = (processed - prev_processed) / (elapsed - prev_elapsed)
+            last_sample[snap_id] = (processed, elapsed)
+
+            # progress is against the bytes left to copy, not files reused from earlier snapshots
+            remaining = max(total - processed, 0)
+            percent = min(100.0 * processed / total, 100.0) if total > 0 else 0.0
+            if total > 0 and throughput > 0:
+                eta = str(timedelta(seconds=int(remaining / throughput)))
+            else:
+                eta = 'unknown'
+            interval = min(interval, next_poll_interval(remaining, throughput,
+                                                        min_interval, max_interval))
+
+            __say("[%s] %s %.1f%% (%i/%i shards, %s of %s) %s/s ETA %s" % (
+                datetime.now().strftime('%H:%M:%S'), snap_id, percent, done, shards,
+                __format_bytes(processed), __format_bytes(total),
+                __format_bytes(throughput), eta))
+
+        if __verbose():
+            __say("   status poll took %.3fs, next poll in %.1fs" % (poll_time, interval))
+        time.sleep(interval)
+
     end_time = datetime.now()
-    sys.stdout.write("\n")
     delta = end_time - start_time
-    print "Total elapsed time: %s" % delta
+    avg_poll_time = sum(poll_times) / len(poll_times)
+    __say("Total elapsed time: %s" % delta)
+    __say("Status polls: %i (avg %.3fs, max %.3fs)" % (len(poll_times), avg_poll_time,
+                                                      max(poll_times)))
+    return {'elapsed': delta.total_seconds(), 'polls': len(poll_times),
+            'avg_poll_time': avg_poll_time, 'max_poll_time': max(poll_times)}
+
+
+def parse_interval(value):
+    '''Converts an interval such as 3600, "90s", "15m", "6h" or "1d" to seconds.'''
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    value = str(value).strip().lower()
+    try:
+        if value[-1:] in units:
+            return int(float(value[:-1]) * units[value[-1]])
+        return int(float(value))
+    except ValueError:
+        raise EsBackupError("Invalid interval [%s]! Expected seconds, or i.e. '15m', '6h', '1d'." % value)
+
+
+def write_prometheus_textfile(path, lines):
+    '''Atomically writes metric lines to a Prometheus node_exporter textfile.'''
+    tmp_path = "%s.%i.tmp" % (path, os.getpid())
+    with open(tmp_path, 'w') as fp:
+        fp.write('\n'.join(lines) + '\n')
+    os.rename(tmp_path, path)
+
+
+def report_request_stats(stats, timings=False, metrics_file=None):
+    '''Prints the request stats as a table on stderr and/or writes them to a Prometheus
+    textfile. Registered with atexit by the --timings/--timings-file options.'''
+    if timings:
+        print >>sys.stderr, "%-40s %-32s %6s %9s %8s %8s %8s %10s %7s %6s" % (
+            'CLUSTER', 'ENDPOINT', 'COUNT', 'TOTAL(s)', 'AVG(ms)', 'P95(ms)', 'MAX(ms)', 'BYTES',
+            'RETRIES', 'ERRORS')
+        for (cluster, endpoint, s) in stats.summary():
+            print >>sys.stderr, "%-40s %-32s %6i %9.3f %8.1f %8.1f %8.1f %10s %7i %6i" % (
+                cluster, endpoint, s['count'], s['seconds'], 1000 * s['seconds'] / s['count'],
+                1000 * s['p95'], 1000 * s['max'], __format_bytes(s['bytes']), s['retries'],
+                s['errors'])
+    if metrics_file:
+        write_prometheus_textfile(metrics_file, stats.prometheus_lines())
+
+
+def __log(msg):
+    print "[%s] %s" % (datetime.now().strftime('%Y/%m/%d %H:%M:%S'), msg)
+    sys.stdout.flush()
+
+
+def __run_cluster_schedules(cfg, cluster_name, schedules, state, tick, workers):
+    '''Scheduler loop for a single cluster; see run_scheduler(). Expects the schedules'
+    interval and offset to be parsed already.'''
+    now = time.time()
+    for sched in schedules:
+        # schedules fire on interval boundaries (plus an optional offset), like cron would
+        sched['next_due'] = (int((now - sched['offset']) / sched['interval']) + 1) * sched['interval'] + sched['offset']
+
+    while True:
+        try:
+            now = time.time()
+            for sched in schedules:
+                if now >= sched['next_due']:
+                    snapshot = (sched['repo'], datetime.utcnow().strftime(sched['name']),
+                                sched.get('indices', '*'))
+                    if snapshot not in state['queue'] and snapshot != state['running']:
+                        state['queue'].append(snapshot)
+                        __log("[%s] Queued snapshot [%s/%s]." % (cluster_name, snapshot[0], snapshot[1]))
+                    while sched['next_due'] <= now:
+                        sched['next_due'] += sched['interval']
+
+            if state['running'] or state['queue']:
+                es = connect_cluster(cfg, cluster_name)
+                (running, _) = poll_snapshot_status(es, __list_repos(es), workers)
+
+                if state['running'] and not running:
+                    (repo, snap, _) = state['running']
+                    try:
+                        snapshots = es.snapshot.get(repository=repo, snapshot=snap)['snapshots']
+                    except exceptions.NotFoundError:
+                        # i.e. already pruned; there's nothing left to wait for
+                        snapshots = []
+                    if not snapshots:
+                        __log("[%s] Snapshot [%s/%s] finished, but can't be found; counting it as failed." % (cluster_name, repo, snap))
+                    else:
+                        if snapshots[0]['state'] == 'SUCCESS':
+                            state['last_success'] = time.time()
+                        __log("[%s] Snapshot [%s/%s] finished with state [%s]." % (cluster_name, repo, snap, snapshots[0]['state']))
+                    state['running'] = None
+
+                if not running and state['queue']:
+                    (repo, snap, indices) = state['queue'].pop(0)
+                    try:
+                        es.snapshot.create(repository=repo, snapshot=snap,
+                                           body=json.dumps({'indices': indices, 'ignore_unavailable': False}),
+                                           wait_for_completion=False)
+                        state['running'] = (repo, snap, indices)
+                        __log("[%s] Started snapshot [%s/%s]." % (cluster_name, repo, snap))
+                    except exceptions.TransportError as e:
+                        __log("[%s] Failed to start snapshot [%s/%s]: %s" % (cluster_name, repo, snap, e))
+        except Exception as e:
+            state['errors'] += 1
+            __log("[%s] ERROR: %s" % (cluster_name, e))
+
+        time.sleep(tick)
+
+
+def __schedule_thread(cfg, cluster_name, schedules, state, tick, workers):
+    '''Runs __run_cluster_schedules(), marking the cluster's state as down if it ever dies.'''
+    try:
+        __run_cluster_schedules(cfg, cluster_name, schedules, state, tick, workers)
+    except BaseException as e:
+        state['errors'] += 1
+        __log("[%s] ERROR: Scheduler thread died: %s" % (cluster_name, e))
+    finally:
+        state['up'] = False
+
+
+def run_scheduler(cfg, cluster_names, tick=SCHEDULER_TICK, metrics_file=None, workers=POLL_WORKERS):
+    '''Runs the snapshot schedules from the 'schedules' config section forever.
+
+    Each cluster gets its own thread and queue of snapshots; a queued snapshot is started as
+    soon as no snapshot is running in any of the cluster's repos, so only one runs per
+    cluster at a time. If metrics_file is given, the queue depth, running state, error count,
+    whether its thread is up and time of the last successful snapshot of each cluster are
+    written to it as Prometheus metrics, along with the RequestStats of every request made to
+    the clusters. Every schedule is validated before any thread starts.
+    '''
+    if metrics_file:
+        request_stats = RequestStats()
+        REQUEST_HOOKS.append(request_stats.record)
+
+    all_schedules = {}
+    for cluster_name in cluster_names:
+        schedules = [dict(sched) for sched in cfg.get('schedules', {}).get(cluster_name, [])]
+        if not schedules:
+            continue
+        for sched in schedules:
+            for k in ['repo', 'name', 'interval']:
+                if not sched.has_key(k):
+                    raise EsBackupError("Schedule for cluster [%s] is missing key [%s]!" % (cluster_name, k))
+            try:
+                sched['interval'] = parse_interval(sched['interval'])
+                sched['offset'] = parse_interval(sched.get('offset', 0))
+            except EsBackupError as e:
+                raise EsBackupError("Schedule [%s] for cluster [%s]: %s" % (sched['name'], cluster_name, e))
+            if sched['interval'] <= 0:
+                raise EsBackupError("Schedule [%s] for cluster [%s] needs a positive interval!"
+                                    % (sched['name'], cluster_name))
+        all_schedules[cluster_name] = schedules
+
+    if not all_schedules:
+        raise EsBackupError("No snapshot schedules were found for cluster(s): %s" % ', '.join(cluster_names))
+
+    states = {}
+    for (cluster_name, schedules) in sorted(all_schedules.items()):
+        states[cluster_name] = {'queue': [], 'running': None, 'last_success': None, 'errors': 0, 'up': True}
+        t = threading.Thread(target=__schedule_thread,
+                             args=(cfg, cluster_name, schedules, states[cluster_name], tick, workers))
+        t.daemon = True
+        t.start()
+        __log("[%s] Scheduling %i snapshot schedule(s)." % (cluster_name, len(schedules)))
+
+    while True:
+        if metrics_file:
+            now = time.time()
+            lines = ['# TYPE esbackup_schedule_queue_depth gauge',
+                     '# TYPE esbackup_schedule_snapshot_running gauge',
+                     '# TYPE esbackup_schedule_up gauge',
+                     '# TYPE esbackup_schedule_errors_total counter',
+                     '# TYPE esbackup_schedule_last_success_age_seconds gauge']
+            for (cluster_name, state) in sorted(states.items()):
+                lines.append('esbackup_schedule_queue_depth{cluster="%s"} %i' % (cluster_name, len(state['queue'])))
+                lines.append('esbackup_schedule_snapshot_running{cluster="%s"} %i' % (cluster_name, bool(state['running'])))
+                lines.append('esbackup_schedule_up{cluster="%s"} %i' % (cluster_name, state['up']))
+                lines.append('esbackup_schedule_errors_total{cluster="%s"} %i' % (cluster_name, state['errors']))
+                if state['last_success'] is not None:
+                    lines.append('esbackup_schedule_last_success_age_seconds{cluster="%s"} %.0f'
+                                 % (cluster_name, now - state['last_success']))
+            write_prometheus_textfile(metrics_file, lines + request_stats.prometheus_lines())
+        time.sleep(tick)
+
+
+class PerThreadOutput(object):
+    '''A stand-in for sys.stdout/sys.stderr which can buffer writes on a per-thread basis,
+    so output from concurrent cluster operations can be printed as labelled blocks.'''
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def capture(self):
+        '''Start buffering writes made by the calling thread.'''
+        self.local.buffer = StringIO()
+
+    def release(self):
+        '''Stop buffering writes made by the calling thread, returning what was written.'''
+        data = self.local.buffer.getvalue()
+        self.local.buffer = None
+        return data
+
+    def write(self, data):
+        buf = getattr(self.local, 'buffer', None)
+        if buf is not None:
+            buf.write(data)
+        else:
+            self.stream.write(data)
+
+    def flush(self):
+        if getattr(self.local, 'buffer', None) is None:
+            self.stream.flush()
+
+
+def fan_out(cluster_names, func, workers=FANOUT_WORKERS):
+    '''Runs func(cluster_name) for each cluster concurrently. Output from each cluster is
+    printed as a block of "[cluster_name] ..." lines once that cluster finishes.
+
+    Returns ({cluster_name: result}, failed), where failed lists the clusters which raised,
+    exited non-zero, or returned a result reporting failures.
+    '''
+    stdout = PerThreadOutput(sys.stdout)
+    stderr = PerThreadOutput(sys.stderr)
+
+    def run(cluster_name):
+        stdout.capture()
+        stderr.capture()
+        result = None
+        try:
+            result = __materialize(func(cluster_name))
+            ok = not __failed(result)
+        except SystemExit as e:
+            ok = e.code in (0, None)
+        except Exception as e:
+            ok = False
+            result = {'error': str(e)}
+            print >>sys.stderr, "ERROR: %s" % e
+        return (cluster_name, ok, result, stdout.release(), stderr.release())
+
+    results = {}
+    failed = []
+    (sys.stdout, sys.stderr) = (stdout, stderr)
+    pool = ThreadPool(min(workers, len(cluster_names)))
+    try:
+        for (cluster_name, ok, result, out, err) in pool.imap_unordered(run, cluster_names):
+            results[cluster_name] = result
+            for line in out.splitlines():
+                stdout.stream.write("[%s] %s\n" % (cluster_name, line))
+            for line in err.splitlines():
+                stderr.stream.write("[%s] %s\n" % (cluster_name, line))
+            stdout.stream.flush()
+            if not ok:
+                failed.append(cluster_name)
+    finally:
+        pool.close()
+        (sys.stdout, sys.stderr) = (stdout.stream, stderr.stream)
+    return (results, failed)
+
+
+def connect_cluster(cfg, cluster_name):
+    '''Returns an elasticsearch connection to the named cluster from the config.'''
+    if not cfg['clusters'].has_key(cluster_name):
+        raise EsBackupError("No key [%s] in 'clusters' section of the config!\nAvailable clusters: %s"
+                     % (cluster_name, cfg['clusters'].keys()))
+    return elasticsearch_connection(cfg['clusters'][cluster_name],
+                                    cfg['username'],
+                                    cfg['password'],
+                                    cfg['ca_cert_path'])
+
+
+def __cluster_error(cluster_name, error):
+    '''Wraps a failed request to a cluster in an EsBackupError.'''
+    return EsBackupError("Request to cluster [%s] failed: %s" % (cluster_name, error))
+
+
+def __translate_errors(rows, cluster_name):
+    '''Yields the rows of a listing, turning a failed request while listing into EsBackupError.'''
+    try:
+        for row in rows:
+            yield row
+    except exceptions.TransportError as e:
+        raise __cluster_error(cluster_name, e)
+
+
+def run_command(es, cluster_name):
+    '''Runs the subcommand given on the command line against a single cluster, returning
+    its result. With --output text, listings are printed here and nothing is returned.
+    Failed requests to the cluster are raised as EsBackupError.'''
+    try:
+        result = __run_command(es, cluster_name)
+    except exceptions.TransportError as e:
+        raise __cluster_error(cluster_name, e)
+    if isinstance(result, types.GeneratorType):
+        return __translate_errors(result, cluster_name)
+    return result
+
+
+def __run_command(es, cluster_name):
+    '''Does the work of run_command().'''
+    if OPTS.no_cache:
+        catalog_file = None
+    else:
+        catalog_file = cache_path(CFG, cluster_name, 'catalog')
+    catalog_ttl = CFG.get('catalog_ttl', CATALOG_TTL)
+
+    if OPTS.command == 'create_repo':
+        # if --s3-role-arn is supplied, we'll use that instead of the config.yaml value
+        if OPTS.s3_role_arn == '':
+            if __verbose():
+                __say("No --s3-role-arn supplied. Using value from config.yaml...")
+            role_arn = CFG['clusters'][cluster_name]['s3_role_arn']
+        else:
+            role_arn = OPTS.s3_role_arn
+
+        if OPTS.read_only:
+            return create_repo(es, OPTS.repo_name, OPTS.s3_bucket, OPTS.s3_region, role_arn,
+                               read_only='true')
+        else:
+            return create_repo(es, OPTS.repo_name, OPTS.s3_bucket, OPTS.s3_region, role_arn,
+                               read_only='false')
+
+    elif OPTS.command == 'delete_repo':
+        return delete_repo(es, OPTS.repo_name)
+
+    elif OPTS.command == 'create_snapshot':
+        return create_snapshot(es, OPTS.indices, OPTS.snapshot_name)
+
+    elif OPTS.command == 'delete_snapshot':
+        return delete_snapshot(es, OPTS.snapshot_name)
+
+    elif OPTS.command == 'prune_snapshots':
+        return prune_snapshots(es, OPTS.keep_last, OPTS.keep_daily, OPTS.keep_monthly,
+                               repos=OPTS.repos.split(',') if OPTS.repos else None,
+                               pattern=OPTS.pattern,
+                               catalog_file=catalog_file, ttl=catalog_ttl,
+                               dry_run=OPTS.dry_run, workers=OPTS.max_concurrent_deletes)
+
+    elif OPTS.command == 'restore_snapshot':
+        # rename_pattern and rename_replacement are mutually dependent options -- either they're both supplied, or they're both ommitted.
+        if OPTS.rename_pattern == '' and OPTS.rename_replacement != '':
+            raise EsBackupError("You must supply a --rename-pattern value when supplying a --rename-replacement!")
+        elif OPTS.rename_pattern != '' and OPTS.rename_replacement == '':
+            raise EsBackupError("You must supply a --rename-replacement value when supplying a --rename-pattern!")
+
+        index_settings = {}
+        for setting in OPTS.index_settings:
+            try:
+                (key, value) = setting.split('=', 1)
+            except ValueError:
+                raise EsBackupError("Index settings must be in the format \"key=value\"! Got [%s]." % setting)
+            index_settings[key] = value
+        if OPTS.replicas_during_restore is not None:
+            index_settings['index.number_of_replicas'] = OPTS.replicas_during_restore
+
+        result = restore_snapshot(es, OPTS.snapshot_name, OPTS.indices, OPTS.rename_pattern,
+                                  OPTS.rename_replacement, index_settings)
+        if OPTS.watch or OPTS.aliases or OPTS.final_replicas is not None:
+            if not result['accepted']:
+                raise EsBackupError("The cluster didn't accept the restore of snapshot [%s]!" % OPTS.snapshot_name)
+            index_names = restored_index_names(es, OPTS.snapshot_name, OPTS.indices,
+                                               OPTS.rename_pattern, OPTS.rename_replacement)
+            result['recovery'] = watch_restore(es, index_names, final_replicas=OPTS.final_replicas,
+                                               aliases=OPTS.aliases,
+                                               timeout=parse_interval(OPTS.watch_timeout))
+        # NOTE: We'll probably want to handle some additional options eventually, like ignore_unavailable or include_global_state.
+        #       Also, we should probably add handling for "include_aliases: false" so we can delete/recreate aliases separately.
+        return result
+
+    elif OPTS.command == 'show_snapshots':
+        filters = {'repos': OPTS.repos.split(',') if OPTS.repos else None,
+                   'pattern': OPTS.pattern,
+                   'since': parse_date(OPTS.since) if OPTS.since else None,
+                   'until': parse_date(OPTS.until) if OPTS.until else None,
+                   'page_size': OPTS.page_size}
+        if OPTS.output == 'text':
+            show_snapshots(es, catalog_file, catalog_ttl, output_format=OPTS.format, **filters)
+        else:
+            return (dict(s, repository=r) for (r, s) in listed_snapshots(es, catalog_file, catalog_ttl, **filters))
+
+    elif OPTS.command == 'analyze_snapshots':
+        report = analyze_snapshots(es, catalog_file, catalog_ttl,
+                                   stats_file=None if OPTS.no_cache else cache_path(CFG, cluster_name, 'stats'),
+                                   repos=OPTS.repos.split(',') if OPTS.repos else None,
+                                   pattern=OPTS.pattern,
+                                   since=parse_date(OPTS.since) if OPTS.since else None,
+                                   until=parse_date(OPTS.until) if OPTS.until else None,
+                                   top=OPTS.top, workers=OPTS.poll_workers)
+        if OPTS.output != 'text':
+            return report
+        show_snapshot_analysis(report)
+
+    elif OPTS.command == 'watch_snapshot':
+        return watch_snapshot(es, OPTS.poll_workers, OPTS.min_interval, OPTS.max_interval)
+
+    elif OPTS.command == 'set_alias':
+        return create_alias(es, OPTS.alias_name, OPTS.index)
+
+    elif OPTS.command == 'delete_alias':
+        return delete_alias(es, OPTS.alias_name, OPTS.index)
+
+    elif OPTS.command == 'swap_aliases':
+        mappings = read_alias_mappings(OPTS.mapping_file, OPTS.mappings)
+        if not mappings:
+            raise EsBackupError("You must supply alias mappings, either as arguments or with --mapping-file!")
+        return swap_aliases(es, mappings, OPTS.dry_run)
+
+    elif OPTS.command == 'show_aliases':
+        if OPTS.cached and not OPTS.no_cache:
+            aliases_file = cache_path(CFG, cluster_name, 'aliases')
+        else:
+            aliases_file = None
+        if OPTS.output == 'text':
+            show_aliases(es, alias=OPTS.alias, index=OPTS.alias_index, dangling=OPTS.dangling,
+                         cache_file=aliases_file, ttl=catalog_ttl)
+            return
+        view = alias_view(es, alias=OPTS.alias, index=OPTS.alias_index, dangling=OPTS.dangling,
+                          cache_file=aliases_file, ttl=catalog_ttl)
+        if OPTS.dangling:
+            return [{'index': i} for i in view]
+        elif OPTS.alias_index is not None:
+            return [{'index': i, 'aliases': view[i]} for i in sorted(view)]
+        return [{'alias': a, 'indices': view[a]} for a in sorted(view)]
+
+    elif OPTS.command == 'delete_index':
+        plan = plan_index_deletion(es, OPTS.index, OPTS.older_than)
+        if not plan:
+            raise EsBackupError("No indices matched %s!" % OPTS.index)
+
+        total_bytes = sum(size for (_, size) in plan)
+        if OPTS.dry_run or __verbose() or len(plan) > 1:
+            for (index_name, size) in plan:
+                __say("   %-40s %10s" % (index_name, __format_bytes(size)))
+        __say("%i index(es) matched, %s would be reclaimed." % (len(plan), __format_bytes(total_bytes)))
+        result = {'planned': [{'index': i, 'store.size': size} for (i, size) in plan],
+                  'reclaimed_bytes': total_bytes, 'dry_run': OPTS.dry_run, 'deleted': [], 'failed': []}
+        if OPTS.dry_run:
+            return result
+
+        if not OPTS.force:
+            if OPTS.output != 'text':
+                raise EsBackupError("delete_index needs --force or --dry-run with --output %s!" % OPTS.output)
+            resp = raw_input("Are you sure you want to permanently delete %i index(es) (y/n)? " % len(plan))
+            if resp.lower() != 'y':
+                __say("Not deleting index.")
+                return result
+
+        result.update(delete_indices(es, [index_name for (index_name, _) in plan], OPTS.batch_chars,
+                                     OPTS.max_concurrent))
+        return result
+
+    elif OPTS.command == 'show_indices':
+        columns = OPTS.columns.split(',')
+        # 'column:desc' on the command line is '-column' to iter_indices()
+        (sort, _, order) = OPTS.sort.partition(':')
+        if order not in ('', 'asc', 'desc'):
+            raise EsBackupError("Invalid sort order [%s]! Expected 'asc' or 'desc'." % order)
+        if order == 'desc':
+            sort = '-' + sort.lstrip('-')
+        filters = {'pattern': OPTS.pattern,
+                   'columns': columns,
+                   'health': OPTS.health.split(',') if OPTS.health else None,
+                   'min_bytes': parse_bytes(OPTS.min_size) if OPTS.min_size else 0,
+                   'min_docs': OPTS.min_docs,
+                   'sort': sort or None}
+        if OPTS.output == 'text':
+            show_indices(es, **filters)
+        else:
+            return (dict((c, row.get(c)) for c in columns) for row in iter_indices(es, **filters))
+
+    else:
+        raise EsBackupError("[%s] is not a valid subcommand!" % OPTS.command)
 
 
 
@@ -286,10 +2231,24 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Provides functions for managing AWS ElasticSearch snapshots.")
     parser.add_argument('-f', '--config-file', dest='cfg_file', help="The yaml config to load settings from. (default: config.yaml)", default='config.yaml')
     parser.add_argument('-v', '--verbose', action='store_true', help="Provide more verbose output.")
+    parser.add_argument('-o', '--output', dest='output', choices=['text', 'json', 'ndjson'], default='text',
+                        help="Print the command's result as human text, one json document, or one json object per line. (default: text)")
+    parser.add_argument('--no-cache', dest='no_cache', action='store_true', default=False,
+                        help="Always query the cluster and re-parse the config, bypassing the local caches.")
+    parser.add_argument('-c', '--clusters', dest='clusters', default='',
+                        help="Comma-separated list of clusters to run the subcommand on concurrently, instead of a single cluster_name.")
+    parser.add_argument('--all-clusters', dest='all_clusters', action='store_true', default=False,
+                        help="Run the subcommand concurrently on every cluster in the config file.")
+    parser.add_argument('--timings', dest='timings', action='store_true', default=False,
+                        help="Print per-endpoint request latency, size, retry and error stats to stderr at exit.")
+    parser.add_argument('--timings-file', dest='timings_file', default='',
+                        help="Write per-endpoint request stats to this Prometheus textfile at exit.")
+    parser.add_argument('--fanout-workers', dest='fanout_workers', type=int, default=FANOUT_WORKERS,
+                        help="Max number of clusters to operate on at once. (default: %i)" % FANOUT_WORKERS)
     subparsers = parser.add_subparsers(dest='command', description="valid subcommands")
 
     create_repo_parser = subparsers.add_parser('create_repo', help="Registers a snapshot repository in the specified cluster.")
-    create_repo_parser.add_argument('cluster_name', help="The cluster to register the repo in.")
+    create_repo_parser.add_argument('cluster_name', nargs='?', help="The cluster to register the repo in.")
     create_repo_parser.add_argument('repo_name', help="The name of the repository you'd like to register.")
     create_repo_parser.add_argument('-b', '--s3-bucket', dest='s3_bucket', help="The S3 bucket to use for the repo.")
     create_repo_parser.add_argument('-r', '--s3-region', dest='s3_region', default='us-west-2', help="The AWS S3 region for the bucket. (default: us-west-2)")
@@ -297,166 +2256,241 @@ if __name__ == "__main__":
     create_repo_parser.add_argument('--s3-role-arn', dest='s3_role_arn', default='', help="The IAM role ARN used by elasticsearch to access S3. (default: value from config.yaml)")
 
     delete_repo_parser = subparsers.add_parser('delete_repo', help="Delete the specified repo from ElasticSearch (does not delete snapshot data).")
-    delete_repo_parser.add_argument('cluster_name', help="The cluster (as defined in the config file) to remove the snapshot repository from.")
+    delete_repo_parser.add_argument('cluster_name', nargs='?', help="The cluster (as defined in the config file) to remove the snapshot repository from.")
     delete_repo_parser.add_argument('repo_name', help="The repository you'd like to remove.")
 
     create_snap_parser = subparsers.add_parser('create_snapshot', help="Create a snapshot on the specified cluster.")
-    create_snap_parser.add_argument('cluster_name', help="The cluster (as defined in the config file) to snapshot.")
+    create_snap_parser.add_argument('cluster_name', nargs='?', help="The cluster (as defined in the config file) to snapshot.")
     create_snap_parser.add_argument('snapshot_name', metavar='repo/snapshot', help="The snapshot to be created.")
     create_snap_parser.add_argument('-i', '--indices', dest='indices', default='*', help="The list of indices to include in the snapshot. (default: all indices)")
 
     delete_snap_parser = subparsers.add_parser('delete_snapshot', help="Delete the specified snapshot from the repo.")
-    delete_snap_parser.add_argument('cluster_name', help="The cluster (as defined in the config file) to delete the snapshot from.")
+    delete_snap_parser.add_argument('cluster_name', nargs='?', help="The cluster (as defined in the config file) to delete the snapshot from.")
     delete_snap_parser.add_argument('snapshot_name', metavar='repo/snapshot', help="The snapshot to be deleted.")
 
+    prune_snaps_parser = subparsers.add_parser('prune_snapshots', help="Delete all snapshots not kept by the given retention rules.")
+    prune_snaps_parser.add_argument('cluster_name', nargs='?', help="The cluster (as defined in the config file) to prune snapshots from.")
+    prune_snaps_parser.add_argument('--keep-last', dest='keep_last', type=int, default=0, help="Keep the newest N successful snapshots.")
+    prune_snaps_parser.add_argument('--keep-daily', dest='keep_daily', type=int, default=0, help="Keep the newest successful snapshot of each of the last N days.")
+    prune_snaps_parser.add_argument('--keep-monthly', dest='keep_monthly', type=int, default=0, help="Keep the newest successful snapshot of each of the last N months.")
+    prune_snaps_parser.add_argument('-r', '--repos', dest='repos', default='', help="Comma-separated list of repos to prune. (default: all repos)")
+    prune_snaps_parser.add_argument('-p', '--pattern', dest='pattern', default='*', help="Only consider snapshots whose names match this wildcard pattern. (i.e. 'nightly-*')")
+    prune_snaps_parser.add_argument('-n', '--dry-run', dest='dry_run', action='store_true', default=False, help="Show what would be deleted, without deleting anything.")
+    prune_snaps_parser.add_argument('--max-concurrent-deletes', dest='max_concurrent_deletes', type=int, default=1,
+                                    help="Max number of delete requests in flight at once (ES >= 7.8 only). (default: 1)")
+
     restore_snap_parser = subparsers.add_parser('restore_snapshot', help="Restore the specified snapshot onto the cluster.")
+    restore_snap_parser.add_argument('cluster_name', nargs='?', help="The cluster (as defined in the config file) to restore the snapshot onto.")
     restore_snap_parser.add_argument('snapshot_name', metavar='src_repo/src_snapshot', help="The snapshot to be restored.")
     restore_snap_parser.add_argument('-i', '--indices', dest='indices', default='*', help="The indices to restore from the snapshot. (default: all indices)")
     restore_snap_parser.add_argument('-p', '--rename-pattern', dest='rename_pattern', default='', help="The index pattern to match for renaming purposes. (i.e. 'my_index_(.*)')")
     restore_snap_parser.add_argument('-r', '--rename-replacement', dest='rename_replacement', default='',
                                      help="The replacement name to be given to the restored indexes. (i.e. 'my_restored_index_$1')")
+    restore_snap_parser.add_argument('-s', '--index-setting', dest='index_settings', action='append', default=[], metavar='key=value',
+                                     help="An index setting to apply to the restored indices, i.e. 'index.refresh_interval=-1'. May be repeated.")
+    restore_snap_parser.add_argument('--replicas-during-restore', dest='replicas_during_restore', type=int, default=None,
+                                     help="Restore the indices with this many replicas, i.e. 0 to speed up recovery.")
+    restore_snap_parser.add_argument('--final-replicas', dest='final_replicas', type=int, default=None,
+                                     help="Set the restored indices to this many replicas once recovery completes. (implies --watch)")
+    restore_snap_parser.add_argument('-a', '--alias', dest='aliases', action='append', default=[],
+                                     help="Add this alias to the restored indices once they're green. May be repeated. (implies --watch)")
+    restore_snap_parser.add_argument('-w', '--watch', dest='watch', action='store_true', default=False,
+                                     help="Wait for the restore to complete, reporting recovery progress.")
+    restore_snap_parser.add_argument('--watch-timeout', dest='watch_timeout', default=str(RESTORE_TIMEOUT),
+                                     help="Fail if the watched restore takes longer than this, i.e. '90m', '12h'. (default: %is)" % RESTORE_TIMEOUT)
 
     show_snaps_parser = subparsers.add_parser('show_snapshots', help="Show the status of all snapshots in all repos on the given cluster.")
-    show_snaps_parser.add_argument('cluster_name', help="The cluster (as defined in the config file) to get the snapshot status from.")
+    show_snaps_parser.add_argument('cluster_name', nargs='?', help="The cluster (as defined in the config file) to get the snapshot status from.")
+    show_snaps_parser.add_argument('-r', '--repos', dest='repos', default='', help="Comma-separated list of repos to list. (default: all repos)")
+    show_snaps_parser.add_argument('-p', '--pattern', dest='pattern', default='*', help="Only list snapshots whose names match this wildcard pattern. (i.e. 'nightly-*')")
+    show_snaps_parser.add_argument('--since', dest='since', default='', help="Only list snapshots started at or after this UTC date. (YYYY-MM-DD[THH:MM:SS])")
+    show_snaps_parser.add_argument('--until', dest='until', default='', help="Only list snapshots started at or before this UTC date. (YYYY-MM-DD[THH:MM:SS])")
+    show_snaps_parser.add_argument('--page-size', dest='page_size', type=int, default=SNAPSHOT_PAGE_SIZE,
+                                   help="Number of snapshots to fetch per request when there's no catalog cache yet. (default: %i)" % SNAPSHOT_PAGE_SIZE)
+    show_snaps_parser.add_argument('--format', dest='format', choices=['text', 'table'], default='text',
+                                   help="Text output layout; use -o/--output for json or ndjson. (default: text)")
+
+    analyze_snaps_parser = subparsers.add_parser('analyze_snapshots', help="Report snapshot durations, throughput and growth per repo, and the slowest indices.")
+    analyze_snaps_parser.add_argument('cluster_name', nargs='?', help="The cluster (as defined in the config file) to analyze the snapshots of.")
+    analyze_snaps_parser.add_argument('-r', '--repos', dest='repos', default='', help="Comma-separated list of repos to analyze. (default: all repos)")
+    analyze_snaps_parser.add_argument('-p', '--pattern', dest='pattern', default='*', help="Only analyze snapshots whose names match this wildcard pattern. (i.e. 'nightly-*')")
+    analyze_snaps_parser.add_argument('--since', dest='since', default='', help="Only analyze snapshots started at or after this UTC date. (YYYY-MM-DD[THH:MM:SS])")
+    analyze_snaps_parser.add_argument('--until', dest='until', default='', help="Only analyze snapshots started at or before this UTC date. (YYYY-MM-DD[THH:MM:SS])")
+    analyze_snaps_parser.add_argument('--top', dest='top', type=int, default=ANALYZE_TOP_INDICES,
+                                      help="Number of slowest indices to list. (default: %i)" % ANALYZE_TOP_INDICES)
+    analyze_snaps_parser.add_argument('-w', '--poll-workers', dest='poll_workers', type=int, default=POLL_WORKERS,
+                                      help="Max number of _status requests in flight at once. (default: %i)" % POLL_WORKERS)
 
     watch_snapshot_parser = subparsers.add_parser('watch_snapshot', help="Loops continuously while any snapshots are currently running, returning control only when the cluster is available again.")
-    watch_snapshot_parser.add_argument('cluster_name', help="The cluster (as defined in the config file) to create/update the alias in.")
+    watch_snapshot_parser.add_argument('cluster_name', nargs='?', help="The cluster (as defined in the config file) to create/update the alias in.")
+    watch_snapshot_parser.add_argument('-w', '--poll-workers', dest='poll_workers', type=int, default=POLL_WORKERS,
+                                       help="Max number of repos to query concurrently when polling. (default: %i)" % POLL_WORKERS)
+    watch_snapshot_parser.add_argument('--min-interval', dest='min_interval', type=float, default=MIN_POLL_INTERVAL,
+                                       help="Shortest time to wait between polls, used near completion. (default: %is)" % MIN_POLL_INTERVAL)
+    watch_snapshot_parser.add_argument('--max-interval', dest='max_interval', type=float, default=MAX_POLL_INTERVAL,
+                                       help="Longest time to wait between polls, used on long-running snapshots. (default: %is)" % MAX_POLL_INTERVAL)
 
     create_alias_parser = subparsers.add_parser('set_alias', help="Create or update an alias to point to the specified index/indices.")
-    create_alias_parser.add_argument('cluster_name', help="The cluster (as defined in the config file) to create/update the alias in.")
+    create_alias_parser.add_argument('cluster_name', nargs='?', help="The cluster (as defined in the config file) to create/update the alias in.")
     create_alias_parser.add_argument('alias_name', help="The name of the alias you'd like to create/update.")
     create_alias_parser.add_argument('index', help="The index the alias should reference. Accepts wildcards such as 'index_foo_*'.")
 
     delete_alias_parser = subparsers.add_parser('delete_alias', help="Deletes the specified alias.")
-    delete_alias_parser.add_argument('cluster_name', help="The cluster (as defined in the config file) to create/update the alias in.")
+    delete_alias_parser.add_argument('cluster_name', nargs='?', help="The cluster (as defined in the config file) to create/update the alias in.")
     delete_alias_parser.add_argument('alias_name', help="The name of the alias you'd like to delete.")
     delete_alias_parser.add_argument('-i', '--index', dest='index', default='*', help="The list of indices to remove the alias from. (optional; default = all indices)")
 
-    show_aliases_parser = subparsers.add_parser('show_aliases', help="Show all aliases, along with the indices they reference.")
-    show_aliases_parser.add_argument('cluster_name', help="The cluster (as defined in the config file) to create/update the alias in.")
+    swap_aliases_parser = subparsers.add_parser('swap_aliases', help="Atomically point many aliases at new indices in a single request.")
+    swap_aliases_parser.add_argument('cluster_name', nargs='?', help="The cluster (as defined in the config file) to update the aliases in.")
+    swap_aliases_parser.add_argument('mappings', nargs='*', metavar='alias=index[,index...]', help="Alias mappings to apply.")
+    swap_aliases_parser.add_argument('-m', '--mapping-file', dest='mapping_file', default='',
+                                     help="A yaml file of 'alias: index' or 'alias: [index, ...]' mappings to apply ('-' for stdin).")
+    swap_aliases_parser.add_argument('-n', '--dry-run', dest='dry_run', action='store_true', default=False, help="Show the alias actions, without applying them.")
 
-    delete_index_parser = subparsers.add_parser('delete_index', help="Deletes the specified index.")
-    delete_index_parser.add_argument('cluster_name', help="The cluster (as defined in the config file) to remove the index from.")
-    delete_index_parser.add_argument('index', metavar='index_name', help="The index to delete from the cluster.")
+    show_aliases_parser = subparsers.add_parser('show_aliases', help="Show all aliases, along with the indices they reference.")
+    show_aliases_parser.add_argument('cluster_name', nargs='?', help="The cluster (as defined in the config file) to create/update the alias in.")
+    show_aliases_filters = show_aliases_parser.add_mutually_exclusive_group()
+    show_aliases_filters.add_argument('-a', '--alias', dest='alias', default=None, help="Only show aliases matching this name or wildcard pattern.")
+    show_aliases_filters.add_argument('-i', '--index', dest='alias_index', default=None, help="Show the aliases of indices matching this name or wildcard pattern.")
+    show_aliases_filters.add_argument('--dangling', dest='dangling', action='store_true', default=False, help="List indices which no alias points to.")
+    show_aliases_parser.add_argument('--cached', dest='cached', action='store_true', default=False,
+                                     help="Answer from a local cache of the alias maps, refreshed after catalog_ttl seconds.")
+
+    delete_index_parser = subparsers.add_parser('delete_index', help="Deletes the specified index/indices.")
+    delete_index_parser.add_argument('cluster_name', nargs='?', help="The cluster (as defined in the config file) to remove the index from.")
+    delete_index_parser.add_argument('index', metavar='index_name', nargs='+', help="The index/indices to delete from the cluster. Accepts wildcards such as 'index_foo_*'.")
     delete_index_parser.add_argument('-f', '--force', dest='force', action='store_true', default=False, help="Delete immediately without prompting.")
+    delete_index_parser.add_argument('-n', '--dry-run', dest='dry_run', action='store_true', default=False,
+                                     help="Only show which indices would be deleted, and the space reclaimed.")
+    delete_index_parser.add_argument('--older-than', dest='older_than', type=float, default=None,
+                                     help="Only delete matching indices created more than this many days ago.")
+    delete_index_parser.add_argument('--batch-chars', dest='batch_chars', type=int, default=DELETE_INDEX_BATCH_CHARS,
+                                     help="Max length of the comma-joined index names in one delete request. (default: %i)" % DELETE_INDEX_BATCH_CHARS)
+    delete_index_parser.add_argument('--max-concurrent', dest='max_concurrent', type=int, default=2,
+                                     help="Max number of delete requests in flight at once. (default: 2)")
 
     show_indices_parser = subparsers.add_parser('show_indices', help="Prints a listing of all indices in the cluster.")
-    show_indices_parser.add_argument('cluster_name', help="The cluster (as defined in the config file) to remove the index from.")
+    show_indices_parser.add_argument('cluster_name', nargs='?', help="The cluster (as defined in the config file) to remove the index from.")
+    show_indices_parser.add_argument('-p', '--pattern', dest='pattern', default='*', help="Only list indices matching this name or wildcard pattern. (default: *)")
+    show_indices_parser.add_argument('-c', '--columns', dest='columns', default='index',
+                                     help="Comma-separated _cat/indices columns to show, i.e. 'index,health,docs.count,store.size'. (default: index)")
+    show_indices_parser.add_argument('--health', dest='health', default='', help="Only list indices with this health (comma-separated, i.e. 'yellow,red').")
+    show_indices_parser.add_argument('--min-size', dest='min_size', default='', help="Only list indices whose total store size is at least this big, i.e. '10gb'.")
+    show_indices_parser.add_argument('--min-docs', dest='min_docs', type=int, default=0, help="Only list indices with at least this many documents.")
+    show_indices_parser.add_argument('-s', '--sort', dest='sort', default='index', help="Column to sort by, with an optional ':asc' or ':desc' suffix, i.e. 'store.size:desc'. (default: index)")
+
+    schedule_parser = subparsers.add_parser('schedule', help="Run forever, taking the snapshots defined in the 'schedules' config section. (use --clusters to limit which clusters)")
+    schedule_parser.add_argument('--tick', dest='tick', type=float, default=SCHEDULER_TICK,
+                                 help="Seconds between checks of each cluster's queue and running snapshot. (default: %i)" % SCHEDULER_TICK)
+    schedule_parser.add_argument('--metrics-file', dest='metrics_file', default='',
+                                 help="Write queue depth and last-success age metrics to this Prometheus textfile.")
+    schedule_parser.add_argument('-w', '--poll-workers', dest='poll_workers', type=int, default=POLL_WORKERS,
+                                 help="Max number of repos to query concurrently when polling. (default: %i)" % POLL_WORKERS)
 
     subparsers.add_parser('show_config', help="Print the raw config to the console.")
 
     OPTS = parser.parse_args()
 
+    if OPTS.timings or OPTS.timings_file:
+        STATS = RequestStats()
+        REQUEST_HOOKS.append(STATS.record)
+        atexit.register(report_request_stats, STATS, OPTS.timings, OPTS.timings_file)
+
     # read the config file
-    CFG_FILE = open(OPTS.cfg_file, 'r')
-    CFG = yaml.load(CFG_FILE)
-    CFG_FILE.close()
+    try:
+        CFG = load_config(OPTS.cfg_file, use_cache=not OPTS.no_cache)
+    except (IOError, OSError) as e:
+        __error_exit("Unable to read config file [%s]: %s" % (OPTS.cfg_file, e))
 
     ES_OPERATIONS = [
         'create_repo',
         'delete_repo',
         'create_snapshot',
         'delete_snapshot',
+        'prune_snapshots',
         'restore_snapshot',
         'show_snapshots',
+        'analyze_snapshots',
         'watch_snapshot',
         'set_alias',
         'delete_alias',
+        'swap_aliases',
         'show_aliases',
         'delete_index',
         'show_indices'
     ]
 
-    # get ready for ElasticSearch operations
-    if OPTS.command in ES_OPERATIONS:
-        if not CFG['clusters'].has_key(OPTS.cluster_name):
-            __error_exit("No key [%s] in 'clusters' section of file [%s]!\nAvailable clusters: %s"
-                         % (OPTS.cluster_name, OPTS.cfg_file, CFG['clusters'].keys()))
-
-        ES = elasticsearch_connection(CFG['clusters'][OPTS.cluster_name],
-                                      CFG['username'],
-                                      CFG['password'],
-                                      CFG['ca_cert_path'])
-
+    # subcommands ending in a list of positional arguments, and that list's dest
+    POSITIONAL_LISTS = {
+        'swap_aliases': 'mappings',
+        'delete_index': 'index',
+    }
 
-        ###                                         ###
-        ### Start processing the command & options! ###
-        ###                                         ###
-
-        if OPTS.command == 'create_repo':
-            # if --s3-role-arn is supplied, we'll use that instead of the config.yaml value
-            if OPTS.s3_role_arn == '':
-                if OPTS.verbose:
-                    print "No --s3-role-arn supplied. Using value from config.yaml..."
-                ROLE_ARN = CFG['clusters'][OPTS.cluster_name]['s3_role_arn']
-            else:
-                ROLE_ARN = OPTS.s3_role_arn
-
-            if OPTS.read_only:
-                create_repo(ES, OPTS.repo_name, OPTS.s3_bucket, OPTS.s3_region, ROLE_ARN,
-                            read_only='true')
-            else:
-                create_repo(ES, OPTS.repo_name, OPTS.s3_bucket, OPTS.s3_region, ROLE_ARN,
-                            read_only='false')
-
-        elif OPTS.command == 'delete_repo':
-            delete_repo(ES, OPTS.repo_name)
-
-        elif OPTS.command == 'create_snapshot':
-            create_snapshot(ES, OPTS.indices, OPTS.snapshot_name)
-
-        elif OPTS.command == 'delete_snapshot':
-            delete_snapshot(ES, OPTS.snapshot_name)
-
-        elif OPTS.command == 'restore_snapshot':
-            # rename_pattern and rename_replacement are mutually dependent options -- either they're both supplied, or they're both ommitted.
-            if (OPTS.rename_pattern == '' and OPTS.rename_replacement == '') or (OPTS.rename_pattern != '' and OPTS.rename_replacement != ''):
-                restore_snapshot(ES, OPTS.snapshot_name, OPTS.indices, OPTS.rename_pattern, OPTS.rename_replacement)
-            else:
-                if OPTS.rename_pattern == '':
-                    __error_exit("You must supply a --rename-replacement value when supplying a --rename-pattern!")
-                elif OPTS.rename_replacement == '':
-                    __error_exit("You must supply a --rename-pattern value when supplying a --rename-replacement!")
-            # NOTE: We'll probably want to handle some additional options eventually, like ignore_unavailable or include_global_state.
-            #       Also, we should probably add handling for "include_aliases: false" so we can delete/recreate aliases separately.
-
-        elif OPTS.command == 'show_snapshots':
-            show_snapshots(ES)
-
-        elif OPTS.command == 'watch_snapshot':
-            watch_snapshot(ES)
-
-        elif OPTS.command == 'set_alias':
-            create_alias(ES, OPTS.alias_name, OPTS.index)
-
-        elif OPTS.command == 'delete_alias':
-            delete_alias(ES, OPTS.alias_name, OPTS.index)
-
-        elif OPTS.command == 'show_aliases':
-            show_aliases(ES)
+    if OPTS.command == 'show_config':
+        if OPTS.output == 'text':
+            print yaml.safe_dump(CFG, default_flow_style=False)
+        else:
+            emit(CFG, OPTS.output)
+        sys.exit(0)
 
-        elif OPTS.command == 'delete_index':
-            if OPTS.force:
-                delete_index(ES, OPTS.index)
-            else:
-                resp = raw_input("Are you sure you want to permanently delete index [%s] (y/n)? " % OPTS.index)
-                if resp.lower() == 'y':
-                    delete_index(ES, OPTS.index)
-                else:
-                    print "Not deleting index."
-                    sys.exit(0)
+    if OPTS.command == 'schedule':
+        if OPTS.all_clusters or not OPTS.clusters:
+            CLUSTERS = sorted(CFG.get('schedules', {}).keys())
+        else:
+            CLUSTERS = [c.strip() for c in OPTS.clusters.split(',') if c.strip() != '']
+        try:
+            run_scheduler(CFG, CLUSTERS, OPTS.tick, OPTS.metrics_file, OPTS.poll_workers)
+        except EsBackupError as e:
+            __error_exit(e)
 
-        elif OPTS.command == 'show_indices':
-            show_indices(ES)
+    if OPTS.command not in ES_OPERATIONS:
+        __error_exit("[%s] is not a valid command!" % OPTS.command)
 
-        elif OPTS.command == 'show_config':
-            print yaml.dump(CFG, default_flow_style=False)
+    # work out which cluster(s) to operate on
+    if OPTS.cluster_name and (OPTS.all_clusters or OPTS.clusters) and OPTS.command in POSITIONAL_LISTS:
+        # argparse fills the optional cluster_name first; when fanning out, it's the list's first item
+        dest = POSITIONAL_LISTS[OPTS.command]
+        setattr(OPTS, dest, [OPTS.cluster_name] + getattr(OPTS, dest))
+        OPTS.cluster_name = None
+    if OPTS.cluster_name and (OPTS.all_clusters or OPTS.clusters):
+        __error_exit("Specify either a cluster_name or --clusters/--all-clusters, not both!")
+
+    if OPTS.all_clusters:
+        CLUSTERS = sorted(CFG['clusters'].keys())
+    elif OPTS.clusters:
+        CLUSTERS = [c.strip() for c in OPTS.clusters.split(',') if c.strip() != '']
+    elif OPTS.cluster_name:
+        CLUSTERS = [OPTS.cluster_name]
+    else:
+        __error_exit("You must specify a cluster_name, --clusters or --all-clusters!")
 
-        else:
-            __error_exit("[%s] is not a valid subcommand!" % OPTS.command)
+    for c in CLUSTERS:
+        if not CFG['clusters'].has_key(c):
+            __error_exit("No key [%s] in 'clusters' section of file [%s]!\nAvailable clusters: %s"
+                         % (c, OPTS.cfg_file, CFG['clusters'].keys()))
 
+    if len(CLUSTERS) == 1:
+        try:
+            RESULT = run_command(connect_cluster(CFG, CLUSTERS[0]), CLUSTERS[0])
+            if OPTS.output != 'text':
+                emit(RESULT, OPTS.output)
+        except EsBackupError as e:
+            __error_exit(e)
+        if __failed(RESULT):
+            __error_exit("Command [%s] failed for some items on cluster [%s]!" % (OPTS.command, CLUSTERS[0]))
     else:
-        __error_exit("[%s] is not a valid command!" % OPTS.command)
+        if OPTS.command == 'delete_index' and not OPTS.force and not OPTS.dry_run:
+            __error_exit("delete_index requires --force when run against multiple clusters!")
+
+        (RESULTS, FAILED) = fan_out(CLUSTERS, lambda c: run_command(connect_cluster(CFG, c), c),
+                                    OPTS.fanout_workers)
+        if OPTS.output == 'json':
+            emit(RESULTS, 'json')
+        elif OPTS.output == 'ndjson':
+            for c in sorted(RESULTS):
+                emit(RESULTS[c], 'ndjson', c)
+        if FAILED:
+            __error_exit("Command [%s] failed on cluster(s): %s" % (OPTS.command, ', '.join(FAILED)))
 
 
 # vim: ts=4 sw=4 et
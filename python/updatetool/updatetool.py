@@ -7,6 +7,8 @@
 #     2) de-register the server from each ELB
 #     3) update & reboot
 #     4) re-register the server in each ELB it was registered in before
+#   Servers are patched in batches, concurrently, never taking so many out of an ELB at once
+#   that it drops below a minimum number of InService instances.
 #
 # Author: Devin Cherry <devincherry@gmail.com>
 ##################################################################################################
@@ -15,11 +17,53 @@ import subprocess
 import json
 import inspect
 import logging
+import threading
 
-from argparse import ArgumentParser
-from time import sleep
+from argparse import ArgumentParser, ArgumentTypeError
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from time import sleep, time
 
 import boto3
+from botocore.config import Config
+
+
+# serializes state file updates made from worker threads
+STATE_FILE_LOCK = threading.Lock()
+
+# API call attempts (including retries of throttled calls) and max keep-alive connections
+# for each shared AWS client; see get_client()
+CLIENT_MAX_ATTEMPTS = 10
+CLIENT_MAX_POOL_CONNECTIONS = 50
+
+# seconds between ELB health checks, and the longest to wait for re-registered instances to
+# become InService
+HEALTH_CHECK_DELAY = 5.0
+HEALTHY_MAX_WAIT = 300
+
+# extra seconds to wait past the longest ConnectionDraining timeout for instances to drain
+DRAIN_GRACE = 5
+
+# the boto3 session and clients shared by all threads; see get_client()
+AWS = {'session': None, 'clients': {}}
+AWS_LOCK = threading.Lock()
+
+
+def get_client(service):
+    """Returns the shared boto3 client for an AWS service, creating it on first use.
+
+    boto3 sessions aren't thread-safe, but the clients they create are; so every client is
+    created from one session under a lock, and then shared by all threads.
+    """
+    with AWS_LOCK:
+        client = AWS['clients'].get(service)
+        if client is None:
+            if AWS['session'] is None:
+                AWS['session'] = boto3.session.Session()
+            config = Config(retries={'max_attempts': CLIENT_MAX_ATTEMPTS},
+                            max_pool_connections=CLIENT_MAX_POOL_CONNECTIONS)
+            client = AWS['session'].client(service, config=config)
+            AWS['clients'][service] = client
+        return client
 
 
 def debug_log(msg):
@@ -32,155 +76,188 @@ def debug_log(msg):
     logging.debug("%s  [in %s:%i]", msg, func.co_name, calling_frame.f_lineno)
 
 
-def remove_instance_from_elb(load_balancer_name, instance_id):
-    """Removes an instance from an ELB, and blocks until success or error."""
-    elb = boto3.client("elb")
+class ElbIndex(object):
+    """An index of which ELBs each instance is registered in.
+
+    It's built once per run from a fully paginated describe_load_balancers listing, then kept
+    current from the instance lists returned by each register/deregister call.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.built = False
+        self.members = {}
+        self.elbs = {}
+
+    def refresh(self):
+        """(Re)builds the index from a listing of all ELBs."""
+        elb_client = get_client('elb')
+        members = {}
+        for page in elb_client.get_paginator('describe_load_balancers').paginate():
+            for e in page['LoadBalancerDescriptions']:
+                members[e['LoadBalancerName']] = set(i['InstanceId'] for i in e['Instances'])
+        with self.lock:
+            self.members = {}
+            self.elbs = {}
+            for (load_balancer_name, instance_ids) in members.items():
+                self.__set_members(load_balancer_name, instance_ids)
+            self.built = True
+        logging.info("Indexed [%i] ELBs containing [%i] instances", len(self.members), len(self.elbs))
+
+    def __set_members(self, load_balancer_name, instance_ids):
+        for instance_id in self.members.get(load_balancer_name, set()) - instance_ids:
+            self.elbs[instance_id].discard(load_balancer_name)
+            if not self.elbs[instance_id]:
+                del self.elbs[instance_id]
+        for instance_id in instance_ids:
+            self.elbs.setdefault(instance_id, set()).add(load_balancer_name)
+        self.members[load_balancer_name] = set(instance_ids)
+
+    def update(self, load_balancer_name, instances):
+        """Records an ELB's instances, as returned by a register/deregister call."""
+        with self.lock:
+            self.__set_members(load_balancer_name, set(i['InstanceId'] for i in instances))
+
+    def elbs_for(self, instance_id):
+        """Returns the names of the ELBs an instance is registered in."""
+        if not self.built:
+            self.refresh()
+        with self.lock:
+            return sorted(self.elbs.get(instance_id, set()))
+
+
+# ELB membership for this run; see ElbIndex
+ELB_INDEX = ElbIndex()
+
+
+def wait_for_instance_state(instances_by_elb, state, max_wait):
+    """Polls the health of instances in several ELBs at once, until they've all reached the
+    given state or max_wait seconds have passed.
+
+    instances_by_elb maps each ELB to the IDs of instances to wait for. Each ELB is checked
+    with one describe_instance_health call per tick, for its instances yet to reach the state.
+    Returns the {elb: [instance_id, ...]} of instances which didn't reach it.
+    """
+    elb = get_client('elb')
+    pending = dict((lb, list(ids)) for lb, ids in instances_by_elb.items() if ids)
+    deadline = time() + max_wait
+
+    while pending:
+        for lb in sorted(pending):
+            resp = elb.describe_instance_health(
+                LoadBalancerName=lb,
+                Instances=[{'InstanceId': instance_id} for instance_id in pending[lb]]
+            )
+            debug_log("response was: %s" % (resp))
+
+            for instance_state in resp['InstanceStates']:
+                if instance_state['State'] == state:
+                    pending[lb].remove(instance_state['InstanceId'])
+                    logging.info("Instance [%s] is now [%s] in ELB [%s]",
+                                 instance_state['InstanceId'], state, lb)
+            if not pending[lb]:
+                del pending[lb]
+
+        if not pending or time() >= deadline:
+            break
+        sleep(HEALTH_CHECK_DELAY)
+    return pending
+
+
+def remove_instances_from_elbs(instances_by_elb):
+    """Removes instances from several ELBs, with a single call per ELB, and blocks until
+    they're all OutOfService or the longest ConnectionDraining timeout has passed."""
+    elb = get_client('elb')
 
-    resp = elb.describe_load_balancer_attributes(LoadBalancerName=load_balancer_name)
     timeout = 0
-    if resp['LoadBalancerAttributes']['ConnectionDraining']['Enabled']:
-        timeout = resp['LoadBalancerAttributes']['ConnectionDraining']['Timeout']
-
-    logging.info("Removing instance [%s] from ELB [%s]...", instance_id, load_balancer_name)
-    resp = elb.deregister_instances_from_load_balancer(
-        LoadBalancerName=load_balancer_name,
-        Instances=[
-            {
-                'InstanceId': instance_id
-            },
-        ]
-    )
-    debug_log("response was: %s" % (resp))
-
-    resp = elb.describe_instance_health(
-        LoadBalancerName=load_balancer_name,
-        Instances=[
-            {
-                'InstanceId': instance_id
-            },
-        ]
-    )
-    debug_log("response was: %s" % (resp))
-    elb_instance_state = resp['InstanceStates'][0]['State']
+    for lb in sorted(instances_by_elb):
+        resp = elb.describe_load_balancer_attributes(LoadBalancerName=lb)
+        if resp['LoadBalancerAttributes']['ConnectionDraining']['Enabled']:
+            timeout = max(timeout, resp['LoadBalancerAttributes']['ConnectionDraining']['Timeout'])
+
+    for lb in sorted(instances_by_elb):
+        logging.info("Removing instance(s) %s from ELB [%s]...", instances_by_elb[lb], lb)
+        resp = elb.deregister_instances_from_load_balancer(
+            LoadBalancerName=lb,
+            Instances=[{'InstanceId': instance_id} for instance_id in instances_by_elb[lb]]
+        )
+        debug_log("response was: %s" % (resp))
+        ELB_INDEX.update(lb, resp['Instances'])
 
     # wait for connection draining to complete, if necessary
-    if timeout > 0 and elb_instance_state != 'OutOfService':
-        logging.info("Waiting [%i] seconds for connection draining to complete...", timeout)
-
-        while timeout > 0:
-            sleep(1)
-            timeout -= 1
-
-        sleep(5)
-        resp = elb.describe_instance_health(
-            LoadBalancerName=load_balancer_name,
-            Instances=[
-                {
-                    'InstanceId': instance_id
-                },
-            ]
+    logging.info("Waiting up to [%i] seconds for connection draining to complete...", timeout + DRAIN_GRACE)
+    draining = wait_for_instance_state(instances_by_elb, 'OutOfService', timeout + DRAIN_GRACE)
+    for lb in sorted(draining):
+        logging.error("Instance(s) %s still not OutOfService in ELB [%s]! Continuing", draining[lb], lb)
+
+
+def add_instances_to_elbs(instances_by_elb):
+    """Registers instances in several ELBs, with a single call per ELB, and blocks until
+    they're all healthy or time out. Returns the IDs of the instances which failed to become
+    healthy."""
+    elb = get_client('elb')
+
+    for lb in sorted(instances_by_elb):
+        logging.info("Registering instance(s) %s in ELB [%s]...", instances_by_elb[lb], lb)
+        resp = elb.register_instances_with_load_balancer(
+            LoadBalancerName=lb,
+            Instances=[{'InstanceId': instance_id} for instance_id in instances_by_elb[lb]]
         )
         debug_log("response was: %s" % (resp))
+        ELB_INDEX.update(lb, resp['Instances'])
 
-        if resp['InstanceStates'][0]['State'] != 'OutOfService':
-            logging.error("Instance [%s] State is [%s]! Continuing",
-                          resp['InstanceStates'][0]['InstanceId'],
-                          resp['InstanceStates'][0]['State'])
-        else:
-            logging.info("Instance [%s] has been deregistered from ELB [%s]", instance_id, load_balancer_name)
+    unhealthy = []
+    for lb, ids in sorted(wait_for_instance_state(instances_by_elb, 'InService', HEALTHY_MAX_WAIT).items()):
+        logging.critical("Instance(s) %s failed to become healthy in ELB [%s] within [%i] seconds!",
+                         ids, lb, HEALTHY_MAX_WAIT)
+        unhealthy.extend(i for i in ids if i not in unhealthy)
+    return unhealthy
 
 
-def add_instance_to_elb(load_balancer_name, instance_id):
-    """Registers an instance in an ELB, and blocks until healthy or error."""
-    # max time to wait for instance to become healthy
-    max_wait = 300
-
-    # pause time between checks
-    check_delay = 5.0
-    loop_count = max_wait/check_delay
-
-    elb = boto3.client("elb")
-
-    logging.info("Registering instance [%s] in ELB [%s]...", instance_id, load_balancer_name)
-    resp = elb.register_instances_with_load_balancer(
-        LoadBalancerName=load_balancer_name,
-        Instances=[
-            {
-                'InstanceId': instance_id
-            },
-        ]
-    )
-    debug_log("response was: %s" % (resp))
-
-    healthy = False
-    while not healthy:
-        sleep(check_delay)
-        resp = elb.describe_instance_health(
-            LoadBalancerName=load_balancer_name,
-            Instances=[
-                {
-                    'InstanceId': instance_id
-                },
-            ]
-        )
-
-        debug_log("response was: %s" % (resp))
-
-        if resp['InstanceStates'][0]['State'] == 'InService':
-            healthy = True
-            logging.info("Instance [%s] is now [%s]", instance_id, resp['InstanceStates'][0]['State'])
-        else:
-            loop_count -= 1
-            if loop_count <= 0:
-                logging.critical("Instance [%s] failed to become healthy within [%i] seconds!", instance_id, max_wait)
-                raise Exception("Instance Not Healthy")
+def read_state_file(state_filename):
+    """Returns the {instance_id: [elb, ...]} records in the state file, or {} if there are none."""
+    try:
+        with open(state_filename, 'r') as fp:
+            return json.load(fp)
+    except IOError:
+        debug_log("IOError (no state file?)")
+    except ValueError:
+        debug_log("ValueError (empty state file?)")
+    return {}
 
 
 def add_to_state_file(instance_id, elb_list, state_filename):
     """Add an instance and its ELB list to the state file in case of error."""
-    with open(state_filename, 'w+') as fp:
-        try:
-            records = json.load(fp)
-        except ValueError:
-            records = {}
+    with STATE_FILE_LOCK:
+        records = read_state_file(state_filename)
         records[instance_id] = elb_list
-        json.dump(records, fp, indent=0)
-        debug_log("Added record to state file: %s = %s" % (instance_id, elb_list))
+        with open(state_filename, 'w') as fp:
+            json.dump(records, fp, indent=0)
+    debug_log("Added record to state file: %s = %s" % (instance_id, elb_list))
 
 
 def remove_from_state_file(instance_id, state_filename):
     """Remove an instance from the state file, if it exists."""
-    with open(state_filename, 'w+') as fp:
-        try:
-            records = json.load(fp)
-            del records[instance_id]
-            debug_log("Removed instance [%s] from state file" % (instance_id))
-            json.dump(records, fp, indent=0)
-        except ValueError:
-            debug_log("ValueError (empty state file?)")
-        except KeyError:
+    with STATE_FILE_LOCK:
+        records = read_state_file(state_filename)
+        if instance_id not in records:
             debug_log("KeyError (state file has records, but none for this instance?)")
+            return
+        del records[instance_id]
+        with open(state_filename, 'w') as fp:
+            json.dump(records, fp, indent=0)
+    debug_log("Removed instance [%s] from state file" % (instance_id))
 
 
 def get_elbs_from_state_file(instance_id, state_filename):
     """Gets the list of ELBs for the specified instance from the state file."""
     debug_log("state file = %s" % (state_filename))
-    if os.path.isfile(state_filename):
-        fp = open(state_filename, 'r')
-        try:
-            records = json.load(fp)
-            logging.info("ELBs containing [%s] from prior failed run(s) = %s",
-                         instance_id,
-                         repr(records[instance_id]))
-            return records[instance_id]
-        except ValueError:
-            debug_log("ValueError (empty state file?)")
-            return []
-        except KeyError:
-            debug_log("KeyError (state file has records, but none for this instance?)")
-            return []
-    debug_log("No state file found")
-    return []
+    elbs = read_state_file(state_filename).get(instance_id)
+    if elbs is None:
+        debug_log("No state file record for [%s]" % (instance_id))
+        return []
+    logging.info("ELBs containing [%s] from prior failed run(s) = %s", instance_id, repr(elbs))
+    return elbs
 
 
 def run_ssh_command(host, cmd):
@@ -224,7 +301,7 @@ def install_updates_and_reboot(host):
     else:
         logging.critical("Failed to determine OS flavor.  ***NOT UPDATING HOST***")
         logging.info("Output was:\n---[start output]---\n%s\n---[end output]---\n", os_flavor)
-        exit(1)
+        raise Exception("Unknown OS flavor")
 
     for cmd in commands:
         output = run_ssh_command(host, cmd)
@@ -235,11 +312,25 @@ def install_updates_and_reboot(host):
     sleep((reboot_delay_min * 60) + 10)
 
 
-def get_updateable_instances(environment):
-    """Returns a list of updateable instances in the specified environment."""
+def parse_tag(arg):
+    """Parses a Key=Value command line argument into a (key, value) tuple."""
+    key, sep, value = arg.partition('=')
+    if not key or not sep:
+        raise ArgumentTypeError("expected Key=Value, got [%s]" % arg)
+    return key, value
+
+
+def get_updateable_instances(environment, tags=None, availability_zones=None):
+    """Returns a list of the running updateable instances in the specified environment.
+
+    tags is a list of extra (key, value) tags to select instances by; instances must match
+    every key given, and any of the values given for it. availability_zones limits the
+    instances to those AZs. Each instance is returned as a compact record with its
+    InstanceId, Name, PrivateIpAddress and AvailabilityZone.
+    """
     logging.info("Finding updateable instances...")
-    ec2 = boto3.client('ec2')
-    tag_filter = [
+    ec2 = get_client('ec2')
+    filters = [
         {
             'Name': 'tag:AutoUpdate',
             'Values': ['True', 'true']
@@ -247,45 +338,169 @@ def get_updateable_instances(environment):
         {
             'Name': 'tag:Environment',
             'Values': [environment]
+        },
+        {
+            'Name': 'instance-state-name',
+            'Values': ['running']
         }
     ]
-    instances = [i['Instances'][0] for i in ec2.describe_instances(Filters=tag_filter)['Reservations']]
-    for i in instances:
-        i_name = 'NO_NAME_TAG'
-        for tag in i['Tags']:
-            if tag['Key'] == 'Name':
-                i_name = tag['Value']
-        logging.info("Found EC2 Instance: %s  (%s, %s)", i_name, i['InstanceId'], i['PrivateIpAddress'])
+    values_by_tag = {}
+    for key, value in tags or []:
+        values_by_tag.setdefault(key, []).append(value)
+    for key in sorted(values_by_tag):
+        filters.append({'Name': 'tag:%s' % key, 'Values': values_by_tag[key]})
+    if availability_zones:
+        filters.append({'Name': 'availability-zone', 'Values': list(availability_zones)})
+
+    instances = []
+    for page in ec2.get_paginator('describe_instances').paginate(Filters=filters):
+        for reservation in page['Reservations']:
+            for i in reservation['Instances']:
+                i_name = 'NO_NAME_TAG'
+                for tag in i.get('Tags', []):
+                    if tag['Key'] == 'Name':
+                        i_name = tag['Value']
+                instances.append({
+                    'InstanceId': i['InstanceId'],
+                    'Name': i_name,
+                    'PrivateIpAddress': i.get('PrivateIpAddress'),
+                    'AvailabilityZone': i['Placement']['AvailabilityZone']
+                })
+                logging.info("Found EC2 Instance: %s  (%s, %s, %s)", i_name, i['InstanceId'],
+                             i.get('PrivateIpAddress'), i['Placement']['AvailabilityZone'])
     return instances
 
 
 def find_elbs_for_instance(instance_id):
-    """Returns a list of all ELBs which an instance is registered in."""
-    elb_client = boto3.client('elb')
-
+    """Returns a list of all ELBs which an instance is registered in, from ELB_INDEX."""
     logging.info("Finding ELBs containing instance [%s]...", instance_id)
-    elbs = elb_client.describe_load_balancers()['LoadBalancerDescriptions']
-    elbs_for_instance = []
-    for e in elbs:
-        for registered_instance in e['Instances']:
-            if registered_instance['InstanceId'] == instance_id:
-                logging.info("Found ELB [%s]", e['LoadBalancerName'])
-                elbs_for_instance.append(e['LoadBalancerName'])
+    elbs_for_instance = ELB_INDEX.elbs_for(instance_id)
+    for e in elbs_for_instance:
+        logging.info("Found ELB [%s]", e)
     return elbs_for_instance
 
 
-def bleed_patch(instance, elbs, state_file='updatetool.state'):
-    """Bleed instance from ELBs, patch+reboot, then re-register in ELBs."""
-    add_to_state_file(instance['InstanceId'], elbs, state_file)
-    for elb in elbs:
-        remove_instance_from_elb(elb, instance['InstanceId'])
+def bleed_patch(instances, elbs_by_instance, pool, state_file='updatetool.state'):
+    """Bleed a batch of instances from their ELBs, patch+reboot them concurrently on the
+    worker pool, then re-register them in their ELBs.
 
-    install_updates_and_reboot(instance['PrivateIpAddress'])
+    Each ELB is deregistered from, registered with and health checked for all of the batch's
+    instances in it at once, and draining and health waits run across all ELBs together.
+    Instances which fail to patch aren't re-registered, and stay in the state file. Returns
+    the list of instance IDs which failed.
+    """
+    instances_by_elb = {}
+    for instance in instances:
+        add_to_state_file(instance['InstanceId'], elbs_by_instance[instance['InstanceId']], state_file)
+        for elb in elbs_by_instance[instance['InstanceId']]:
+            instances_by_elb.setdefault(elb, []).append(instance['InstanceId'])
 
-    for elb in elbs:
-        add_instance_to_elb(elb, instance['InstanceId'])
-    remove_from_state_file(instance['InstanceId'], state_file)
+    remove_instances_from_elbs(instances_by_elb)
 
+    failed = []
+    futures = dict((pool.submit(install_updates_and_reboot, i['PrivateIpAddress']), i['InstanceId'])
+                   for i in instances)
+    for future in as_completed(futures):
+        try:
+            future.result()
+        except Exception:
+            logging.exception("Failed to patch instance [%s]!", futures[future])
+            failed.append(futures[future])
+
+    patched = dict((elb, [i for i in ids if i not in failed]) for elb, ids in instances_by_elb.items())
+    patched = dict((elb, ids) for elb, ids in patched.items() if ids)
+    if patched:
+        failed.extend(add_instances_to_elbs(patched))
+
+    for instance in instances:
+        if instance['InstanceId'] not in failed:
+            remove_from_state_file(instance['InstanceId'], state_file)
+    return failed
+
+
+def in_service_instances(load_balancer_name):
+    """Returns the set of instance IDs currently InService in an ELB."""
+    elb = get_client('elb')
+    resp = elb.describe_instance_health(LoadBalancerName=load_balancer_name)
+    debug_log("response was: %s" % (resp))
+    return set(s['InstanceId'] for s in resp['InstanceStates'] if s['State'] == 'InService')
+
+
+def next_batch(pending, elbs_by_instance, in_service, batch_size=None, batch_percent=None,
+               min_in_service=0):
+    """Picks the next instances to patch together, in order, from the pending instances.
+
+    An instance only joins the batch if taking the whole batch out of its ELBs leaves each
+    of them with at least min_in_service InService instances (in_service maps each ELB to
+    its InService instance IDs). With batch_percent, no more than that percentage of an
+    ELB's InService instances (rounded down, but at least one) is taken out at once.
+    """
+    batch = []
+    removed = {}
+    for instance in pending:
+        if batch_size and len(batch) >= batch_size:
+            break
+        elbs = elbs_by_instance[instance['InstanceId']]
+        fits = True
+        for elb in elbs:
+            healthy = in_service.get(elb, set())
+            if instance['InstanceId'] not in healthy:
+                # already out of service, so patching it can't lower the ELB's capacity
+                continue
+            limit = len(healthy) - min_in_service
+            if batch_percent:
+                limit = min(limit, max(1, int(len(healthy) * batch_percent / 100.0)))
+            if removed.get(elb, 0) + 1 > limit:
+                fits = False
+                break
+        if not fits:
+            continue
+        batch.append(instance)
+        for elb in elbs:
+            if instance['InstanceId'] in in_service.get(elb, set()):
+                removed[elb] = removed.get(elb, 0) + 1
+    return batch
+
+
+def rolling_update(instances, elbs_by_instance, batch_size=None, batch_percent=None,
+                   min_in_service=0, state_file='updatetool.state'):
+    """Patches instances batch by batch (see next_batch()) with bleed_patch(), patching each
+    batch's instances concurrently on a worker pool.
+
+    ELB health is checked before each batch is picked. No further batches are started once
+    an instance fails, and the instances left pending are logged. Returns the list of
+    instance IDs which failed or couldn't be patched, including those left pending.
+    """
+    if not batch_size and not batch_percent:
+        batch_size = 1
+    pending = list(instances)
+    failed = []
+
+    with ThreadPoolExecutor(max_workers=batch_size or max(1, len(instances))) as pool:
+        while pending and not failed:
+            elbs = set(elb for i in pending for elb in elbs_by_instance[i['InstanceId']])
+            in_service = dict((elb, in_service_instances(elb)) for elb in elbs)
+            batch = next_batch(pending, elbs_by_instance, in_service, batch_size, batch_percent,
+                               min_in_service)
+            if not batch:
+                logging.critical("Can't patch instances %s without dropping an ELB below [%i] InService instance(s)!",
+                                 [i['InstanceId'] for i in pending], min_in_service)
+                return [i['InstanceId'] for i in pending]
+
+            logging.info("Patching batch of [%i] instance(s) (%i left after this batch): %s",
+                         len(batch), len(pending) - len(batch), [i['InstanceId'] for i in batch])
+            try:
+                failed.extend(bleed_patch(batch, elbs_by_instance, pool, state_file))
+            except Exception:
+                logging.exception("Failed to patch batch %s!", [i['InstanceId'] for i in batch])
+                failed.extend(i['InstanceId'] for i in batch)
+            pending = [i for i in pending if i not in batch]
+
+    if pending:
+        logging.critical("Not patching instance(s) %s after earlier failure(s)!",
+                         [i['InstanceId'] for i in pending])
+        failed.extend(i['InstanceId'] for i in pending)
+    return failed
 
 
 if __name__ == "__main__":
@@ -296,6 +511,16 @@ if __name__ == "__main__":
                         help="Increase verbosity (more 'v's means more verbose)")
     parser.add_argument('-f', '--state-file', type=str, default='updatetool.state',
                         help='Specify an alternate state file location')
+    parser.add_argument('-b', '--batch-size', type=int, default=None,
+                        help='Max number of instances to patch at once (default: 1, or unlimited with --batch-percent)')
+    parser.add_argument('-p', '--batch-percent', type=float, default=None,
+                        help="Max percentage of each ELB's InService instances to patch at once")
+    parser.add_argument('-m', '--min-in-service', type=int, default=0,
+                        help='Never leave an ELB with fewer InService instances than this (default: 0)')
+    parser.add_argument('-t', '--tag', type=parse_tag, action='append', default=[], metavar='KEY=VALUE',
+                        help='Only update instances with this tag (repeatable)')
+    parser.add_argument('-z', '--az', action='append', default=[],
+                        help='Only update instances in this availability zone (repeatable)')
     args = parser.parse_args()
 
     if args.verbose == 0:
@@ -317,10 +542,17 @@ if __name__ == "__main__":
         datefmt='[%Y/%m/%d %H:%M:%S %Z]'
     )
 
-    instances = get_updateable_instances(args.environment)
+    instances = get_updateable_instances(args.environment, tags=args.tag, availability_zones=args.az)
+    elbs_by_instance = {}
     for i in instances:
         # Allows recovery from failures that would leave instance deregistered from ELBs.
-        elbs = list(frozenset(find_elbs_for_instance(i['InstanceId']) +
-                              get_elbs_from_state_file(i['InstanceId'], args.state_file)))
-        bleed_patch(i, elbs, state_file=args.state_file)
+        elbs_by_instance[i['InstanceId']] = list(frozenset(find_elbs_for_instance(i['InstanceId']) +
+                                                           get_elbs_from_state_file(i['InstanceId'], args.state_file)))
+
+    failed = rolling_update(instances, elbs_by_instance, batch_size=args.batch_size,
+                            batch_percent=args.batch_percent, min_in_service=args.min_in_service,
+                            state_file=args.state_file)
+    if failed:
+        logging.critical("Failed to patch instance(s): %s", failed)
+        exit(1)
     logging.info("All done!")